@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+import calendar_cache
+from calendar_cache import TIMEZONE, START_OF_THE_DAY, END_OF_THE_DAY
+
+SLOT = timedelta(minutes=30)
+
+
+def localize(value):
+    if value.tzinfo is None:
+        return TIMEZONE.localize(value)
+    return value.astimezone(TIMEZONE)
+
+
+def midnight(value):
+    return TIMEZONE.localize(datetime(value.year, value.month, value.day))
+
+
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_intervals(intervals, busy):
+    # Both lists are sorted and non-overlapping, so a single sweep is enough
+    free = []
+    i = 0
+    for start, end in intervals:
+        while i < len(busy) and busy[i][1] <= start:
+            i += 1
+        j = i
+        while j < len(busy) and busy[j][0] < end:
+            if busy[j][0] > start:
+                free.append((start, busy[j][0]))
+            start = max(start, busy[j][1])
+            j += 1
+        if start < end:
+            free.append((start, end))
+    return free
+
+
+def working_intervals(start, end):
+    intervals = []
+    day = midnight(start).replace(tzinfo=None)
+    while TIMEZONE.localize(day) <= end:
+        if day.weekday() < 5:
+            work_start = max(start, TIMEZONE.localize(day + START_OF_THE_DAY))
+            work_end = min(end, TIMEZONE.localize(day + END_OF_THE_DAY))
+            if work_start < work_end:
+                intervals.append((work_start, work_end))
+        day += timedelta(days=1)
+    return intervals
+
+
+def _snappers(granularity):
+    # pytz localize is by far the slowest step, midnight is localized once per
+    # day instead of for every boundary
+    midnights = {}
+
+    def floor(value):
+        day = midnights.get(value.date())
+        if day is None:
+            day = midnights[value.date()] = midnight(value)
+        return day + ((value - day) // granularity) * granularity
+
+    def ceil(value):
+        floored = floor(value)
+        return floored if floored == value else floored + granularity
+
+    return floor, ceil
+
+
+def snap_outward(intervals, granularity):
+    floor, ceil = _snappers(granularity)
+    return [(floor(s), ceil(e)) for s, e in intervals]
+
+
+def snap_inward(intervals, granularity):
+    floor, ceil = _snappers(granularity)
+    snapped = [(ceil(s), floor(e)) for s, e in intervals]
+    return [(s, e) for s, e in snapped if s < e]
+
+
+def free_intervals(start, end, busy, granularity=SLOT):
+    start, end = localize(start), localize(end)
+    work = working_intervals(start, end)
+    busy = [(localize(s), localize(e)) for s, e in busy]
+    if granularity:
+        # A slot counts as busy as soon as an event overlaps it
+        work = snap_inward(work, granularity)
+        busy = snap_outward(busy, granularity)
+    return subtract_intervals(work, merge_intervals(busy))
+
+
+def get_free_time(start, end, urls, granularity=SLOT, progress=None):
+    if end <= start:
+        return 0, []
+    busy = calendar_cache.get_busy_intervals(start, end, urls, progress)
+    free = free_intervals(start, end, busy, granularity)
+    total = sum((e - s for s, e in free), timedelta())
+    return total / timedelta(hours=1), free
+
+
+def get_free_intervals(start, end, urls, granularity=SLOT):
+    return get_free_time(start, end, urls, granularity)[1]
+
+
+def get_busy_time(start, end, urls, granularity=SLOT):
+    # Number of free slots of the given granularity
+    hours, _ = get_free_time(start, end, urls, granularity)
+    return round(hours * timedelta(hours=1) / granularity)
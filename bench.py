@@ -0,0 +1,587 @@
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import sqlite3
+
+# The app modules read their paths from the environment when they are imported,
+# and importing dashapp creates its database and callback cache: they must all
+# be in the work directory, which is removed at the end
+WORKDIR = tempfile.mkdtemp(prefix="tame-bench-")
+os.environ["TAME_MANAGEMENT_DB"] = os.path.join(WORKDIR, "tame_management.db")
+os.environ["TAME_MANAGEMENT_CALLBACK_CACHE"] = os.path.join(WORKDIR, "callback_cache")
+os.environ["TAME_MANAGEMENT_CALENDAR_CACHE"] = os.path.join(WORKDIR, "calendar_cache")
+os.environ["TAME_MANAGEMENT_BOARDS"] = os.path.join(WORKDIR, "boards")
+
+import availability
+import calendar_cache
+import capacity
+import dashapp
+import db
+import repository
+import task_cache
+
+# Benchmarks of the page renderers, search, free time and the Jira import on
+# synthetic data: a database of the given number of tasks and calendar feeds of
+# recurring events served over HTTP from this process. Results are written as
+# JSON so that two commits can be compared with --compare.
+
+SIZES = (1000, 10000, 100000)
+REPEAT = 20
+SPRINT_SIZE = 200
+FEEDS = 3
+SERIES = 40  # recurring events per feed
+SINGLE_EVENTS = 400  # one-off events per feed
+RESULTS_DIR = "benchmarks"
+STATUSES = ["To Do", "In Progress", "Blocked", "Done"]
+POLL_INTERVAL = 0.01  # in seconds, for background callbacks
+
+WORDS = """
+account admin alert analytics android api app approval archive audit backend
+backup banner billing bug build cache calendar campaign cart checkout chart
+cleanup client cluster config consent contract cookie coupon crash csv customer
+dashboard database deadline deploy design dialog docs domain download draft
+email endpoint error event export feature feed filter firmware font form
+gateway graph header helpdesk import index invoice ios job kafka label latency
+layout lead legal locale login logo logs mail map marketing merge metrics
+migration mobile modal monitoring newsletter notification onboarding order
+outage pagination partner password payment pdf permission pipeline plan
+pricing printer profile proxy query queue quota release report request role
+rollout router sales schema search security session settings signup sitemap
+sla slack sso staging storage subscription support survey sync table template
+tenant test theme ticket timeout token tooltip tracking translation upload
+user vendor video warehouse webhook widget wizard workflow
+""".split()
+VERBS = """
+add fix update remove refactor migrate review investigate document test
+optimize redesign automate validate configure upgrade clean speed monitor
+""".split()
+FILLER = """
+the a for when with on in after before so that users customers it is should
+can not does from to and or but also still again each every new old
+""".split()
+
+
+def sentence(rng, length):
+    words = [rng.choice(WORDS if rng.random() < 0.4 else FILLER) for _ in range(length)]
+    return " ".join(words).capitalize() + "."
+
+
+def title(rng):
+    return f"{rng.choice(VERBS).capitalize()} {' '.join(rng.sample(WORDS, rng.randint(1, 3)))}"
+
+
+def description(rng):
+    if rng.random() < 0.1:
+        return None
+    return " ".join(sentence(rng, rng.randint(6, 16)) for _ in range(rng.randint(1, 5)))
+
+
+def due_date(rng, today):
+    if rng.random() < 0.3:
+        return None
+    return (today + timedelta(days=rng.randint(-30, 180))).isoformat()
+
+
+def task_rows(count, seed=0):
+    # (title, due_date, sp, description, sprint, status), the first SPRINT_SIZE
+    # in the sprint
+    rng = random.Random(seed)
+    today = date.today()
+    for i in range(count):
+        sprint = i < min(SPRINT_SIZE, count // 5)
+        yield (
+            title(rng),
+            due_date(rng, today),
+            rng.choice([None, 1, 2, 3, 5, 8, 13]),
+            description(rng),
+            sprint,
+            rng.choice(STATUSES) if sprint else rng.choice(STATUSES[:3]),
+        )
+
+
+def create_tasks_db(path, count, seed=0):
+    con = repository.connect(path)
+    db.migrate(con)
+    with db.bulk_import(con):
+        with con:
+            con.executemany(
+                """INSERT INTO tasks (title, due_date, sp, description, sprint, status)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                task_rows(count, seed),
+            )
+    today = date.today()
+    repository.start_sprint(
+        (today - timedelta(days=3)).isoformat(),
+        (today + timedelta(days=11)).isoformat(),
+        con=con,
+    )
+    con.close()
+
+
+def _ics_time(value):
+    return value.strftime("%Y%m%dT%H%M%SZ")
+
+
+def create_ics(seed=0, series=SERIES, single_events=SINGLE_EVENTS):
+    # Weekly and daily meetings (some with exceptions), all-day events and
+    # one-off meetings, starting before the cached window so that the
+    # recurrences have to be expanded into it
+    rng = random.Random(seed)
+    origin = datetime.combine(date.today() - timedelta(days=90), datetime.min.time())
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//tame_management//bench//EN"]
+
+    def event(uid, start, end, *extra):
+        lines.extend(
+            [
+                "BEGIN:VEVENT",
+                f"UID:{uid}@bench",
+                f"DTSTAMP:{_ics_time(origin)}",
+                f"SUMMARY:{title(rng)}",
+                start,
+                end,
+                *extra,
+                "END:VEVENT",
+            ]
+        )
+
+    for i in range(series):
+        start = origin + timedelta(
+            days=rng.randint(0, 6),
+            hours=rng.randint(6, 15),
+            minutes=rng.choice([0, 30]),
+        )
+        end = start + timedelta(minutes=rng.choice([15, 30, 60, 90]))
+        if rng.random() < 0.3:
+            rule = "RRULE:FREQ=DAILY;BYDAY=MO,TU,WE,TH,FR"
+        else:
+            interval = rng.choice([1, 1, 2])
+            rule = f"RRULE:FREQ=WEEKLY;INTERVAL={interval}"
+        extra = [rule]
+        if rng.random() < 0.3:
+            skipped = start + timedelta(weeks=rng.randint(1, 20))
+            extra.append(f"EXDATE:{_ics_time(skipped)}")
+        event(
+            f"series-{seed}-{i}",
+            f"DTSTART:{_ics_time(start)}",
+            f"DTEND:{_ics_time(end)}",
+            *extra,
+        )
+    for i in range(single_events):
+        day = origin + timedelta(days=rng.randint(0, 450))
+        if rng.random() < 0.05:
+            event(
+                f"day-{seed}-{i}",
+                f"DTSTART;VALUE=DATE:{day:%Y%m%d}",
+                f"DTEND;VALUE=DATE:{day + timedelta(days=rng.randint(1, 3)):%Y%m%d}",
+            )
+        else:
+            start = day + timedelta(
+                hours=rng.randint(6, 16), minutes=rng.choice([0, 15, 30, 45])
+            )
+            end = start + timedelta(minutes=rng.choice([30, 45, 60, 120]))
+            event(
+                f"single-{seed}-{i}",
+                f"DTSTART:{_ics_time(start)}",
+                f"DTEND:{_ics_time(end)}",
+            )
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+
+class FeedServer:
+    # Serves the given {path: ics} over HTTP on localhost, with ETags so that
+    # revalidation gets 304 responses like from a real calendar server
+    def __init__(self, feeds):
+        self.feeds = {
+            path: (ics.encode(), hashlib.sha1(ics.encode()).hexdigest())
+            for path, ics in feeds.items()
+        }
+        feeds = self.feeds
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in feeds:
+                    self.send_error(404)
+                    return
+                body, etag = feeds[self.path]
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/calendar")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def urls(self):
+        port = self.server.server_address[1]
+        return [f"http://127.0.0.1:{port}{path}" for path in self.feeds]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeJira:
+    # Stands in for jira.JIRA in from_jira.sync. A tenth of the issues are
+    # updated in the future, so that every incremental sync gets them again. A
+    # minute holds 60 issues, more than a page.
+    def __init__(self, count, seed=0):
+        past = datetime(2024, 1, 1)
+        future = datetime.now() + timedelta(days=1)
+        self.issues = [
+            SimpleNamespace(
+                key=f"BENCH-{i + 1}",
+                fields=SimpleNamespace(
+                    summary=row[0],
+                    duedate=row[1],
+                    customfield_10035=row[2],
+                    description=row[3],
+                    status=SimpleNamespace(name=row[5]),
+                    updated=(
+                        (past if i < count - count // 10 else future)
+                        + timedelta(seconds=i)
+                    ).strftime("%Y-%m-%dT%H:%M:%S.000+0000"),
+                ),
+            )
+            for i, row in enumerate(task_rows(count, seed))
+        ]
+
+    def search_issues(self, jql_str, startAt, maxResults, fields):
+        import from_jira
+
+        issues = self.issues
+        if jql_str.startswith("updated >= "):
+            after = jql_str.split('"')[1]
+            issues = [i for i in issues if from_jira.minute(i) >= after]
+        page = Page(issues[startAt : startAt + maxResults])
+        page.total = len(issues)
+        return page
+
+
+class Page(list):
+    total = 0
+
+
+def measure(function, repeat, setup=None):
+    # The first call is reported on its own, it fills the caches the next ones
+    # are served from
+    times = []
+    for _ in range(repeat + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    first, times = times[0], sorted(times[1:])
+    return {
+        "first": first,
+        "min": times[0],
+        "median": statistics.median(times),
+        "p95": times[min(len(times) - 1, int(0.95 * len(times)))],
+        "mean": statistics.fmean(times),
+        "repeat": repeat,
+    }
+
+
+def search_request(client, value):
+    outputs = [
+        ("search_result", "children"),
+        ("search_page", "data"),
+        ("search_previous", "disabled"),
+        ("search_next", "disabled"),
+    ]
+    response = client.post(
+        "/_dash-update-component",
+        json={
+            "output": ".." + "...".join(f"{id}.{prop}" for id, prop in outputs) + "..",
+            "outputs": [{"id": id, "property": prop} for id, prop in outputs],
+            "inputs": [
+                {"id": "searchbar", "property": "value", "value": value},
+                {"id": "search_previous", "property": "n_clicks", "value": None},
+                {"id": "search_next", "property": "n_clicks", "value": None},
+            ],
+            "state": [
+                {"id": "search_page", "property": "data", "value": None},
+                {"id": "search_session", "property": "data", "value": "bench"},
+                {"id": "url", "property": "pathname", "value": "/search"},
+            ],
+            "changedPropIds": ["searchbar.value"],
+        },
+    )
+    if response.status_code not in (200, 204):
+        raise RuntimeError(f"Search failed with {response.status_code}")
+
+
+def free_time_request(client, start, end):
+    # update_sprint_free_time, a background callback: the first request starts
+    # a job process, the next ones poll it until it returns its result
+    payload = {
+        "output": "sprint_start_notes.children",
+        "outputs": {"id": "sprint_start_notes", "property": "children"},
+        "inputs": [
+            {"id": "sprint_dates_modal", "property": "start_date", "value": start},
+            {"id": "sprint_dates_modal", "property": "end_date", "value": end},
+            {"id": "start_sprint", "property": "n_clicks", "value": None},
+        ],
+        "state": [{"id": "url", "property": "pathname", "value": "/backlog"}],
+        "changedPropIds": ["sprint_dates_modal.end_date"],
+    }
+    response = client.post("/_dash-update-component", json=payload)
+    if response.status_code != 200:
+        raise RuntimeError(f"Free time failed with {response.status_code}")
+    job = response.get_json()
+    while True:
+        time.sleep(POLL_INTERVAL)
+        response = client.post(
+            f"/_dash-update-component?cacheKey={job['cacheKey']}&job={job['job']}",
+            json=payload,
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"Free time failed with {response.status_code}")
+        if "response" in response.get_json():
+            return
+
+
+def clear_calendar_cache():
+    shutil.rmtree(calendar_cache.CACHE_DIR, ignore_errors=True)
+    calendar_cache.clear()
+
+
+def run_size(count, repeat, workdir, urls, selected):
+    path = os.path.join(workdir, f"tasks-{count}.db")
+    start = time.perf_counter()
+    create_tasks_db(path, count)
+    print(f"{count} tasks generated in {time.perf_counter() - start:.1f} s")
+    repository.set_db_path(path)
+    repository.set_setting(
+        "calendars", ";".join(f"Feed {i}|{url}" for i, url in enumerate(urls))
+    )
+    client = dashapp.server.test_client()
+    rng = random.Random(count)
+    queries = [" ".join(rng.sample(WORDS, rng.randint(1, 2))) for _ in range(8)]
+    queries += ["dashbord", "migraton pipline"]  # misspelled, fuzzy search
+    queries = iter(queries * (repeat + 1))
+    today = datetime.combine(date.today(), datetime.min.time())
+    sprint = (today, today + timedelta(days=14))
+    past = (today - timedelta(days=80), today - timedelta(days=50))
+    quarters = (today, today + timedelta(weeks=26))
+    # The end date of a sprint after the downloaded window dragged one day
+    # further each time
+    drag_start = today + timedelta(days=370)
+    drag = (drag_start + timedelta(days=14 + i) for i in range(10**6))
+
+    benchmarks = {
+        "create_cards": (dashapp.create_cards, None),
+        "create_dashboard": (
+            lambda: dashapp.create_dashboard(dashapp.create_cards()),
+            None,
+        ),
+        "create_backlog": (dashapp.create_backlog, None),
+        "search": (
+            lambda: search_request(client, next(queries)),
+            repository._search_cache.clear,
+        ),
+        "get_free_intervals": (
+            lambda: availability.get_free_intervals(*sprint, urls),
+            None,
+        ),
+        "get_busy_time": (lambda: availability.get_busy_time(*sprint, urls), None),
+        # Free hours per week for the next 26 weeks
+        "get_capacity": (lambda: capacity.get_capacity(*quarters, urls), None),
+        # Outside of the window expanded on download, from the raw feeds
+        "get_busy_time_past": (lambda: availability.get_busy_time(*past, urls), None),
+        "get_busy_time_drag": (
+            lambda: availability.get_busy_time(drag_start, next(drag), urls),
+            None,
+        ),
+        # The same through Dash in a job process, which only finds on disk what
+        # the previous jobs expanded
+        "free_hours_background": (
+            lambda: free_time_request(
+                client, drag_start.date().isoformat(), next(drag).date().isoformat()
+            ),
+            calendar_cache.clear,
+        ),
+        # Download, parse and expand every feed
+        "get_busy_time_cold": (
+            lambda: availability.get_busy_time(*sprint, urls),
+            clear_calendar_cache,
+        ),
+    }
+    results = {}
+    for name, (function, setup) in benchmarks.items():
+        if selected and name not in selected:
+            continue
+        results[name] = measure(function, repeat, setup)
+        print(f"  {name}: median {results[name]['median'] * 1000:.2f} ms")
+
+    if not selected or {"jira_import", "jira_sync"} & set(selected):
+        results.update(run_jira(count, workdir))
+    return results
+
+
+def run_jira(count, workdir):
+    try:
+        import from_jira
+    except ImportError as e:
+        print(f"  Skipping the Jira import: {e}")
+        return {}
+    results = {}
+    jira = FakeJira(count)
+    # One full import and one incremental sync of a tenth of the issues, each on
+    # an empty database and then on the imported one
+    with repository.use_db(os.path.join(workdir, f"jira-{count}.db")):
+        results["jira_import"] = measure(
+            lambda: from_jira.sync(jira, full=True, progress=False), 1
+        )
+        results["jira_sync"] = measure(lambda: from_jira.sync(jira, progress=False), 2)
+    for name in ("jira_import", "jira_sync"):
+        print(f"  {name}: median {results[name]['median'] * 1000:.2f} ms")
+    return results
+
+
+def git_commit():
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=cwd,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=cwd,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(dirty)
+
+
+def run(sizes, repeat, selected=None):
+    commit, dirty = git_commit()
+    workdir = WORKDIR
+    server = FeedServer({f"/feed-{i}.ics": create_ics(seed=i) for i in range(FEEDS)})
+    try:
+        dashapp.warm_up()
+        results = {}
+        for count in sizes:
+            results[str(count)] = run_size(
+                count, repeat, workdir, server.urls(), selected
+            )
+            task_cache._caches.clear()
+            repository.close_all()
+    finally:
+        server.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "calendar": {"feeds": FEEDS, "series": SERIES, "single_events": SINGLE_EVENTS},
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold):
+    # Prints the change of the median of every benchmark present in both runs,
+    # returns the ones slower by more than threshold (a fraction)
+    print(f"{baseline['commit'] or '?'} -> {current['commit'] or '?'}")
+    slower = []
+    for size, results in current["results"].items():
+        for name, result in results.items():
+            before = baseline["results"].get(size, {}).get(name)
+            if before is None:
+                continue
+            change = result["median"] / before["median"] - 1
+            flag = ""
+            if change > threshold:
+                flag = "  SLOWER"
+                slower.append((size, name))
+            elif change < -threshold:
+                flag = "  faster"
+            print(
+                f"{size:>7} {name:<22} {before['median'] * 1000:10.2f} ms"
+                f" {result['median'] * 1000:10.2f} ms {change:+7.1%}{flag}"
+            )
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark on synthetic data")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=SIZES,
+        metavar="TASKS",
+        help=f"numbers of tasks to benchmark with (default {' '.join(map(str, SIZES))})",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=REPEAT,
+        help=f"runs per benchmark (default {REPEAT})",
+    )
+    parser.add_argument(
+        "--only", nargs="+", metavar="NAME", help="only run these benchmarks"
+    )
+    parser.add_argument(
+        "--output", help=f"result file (default {RESULTS_DIR}/<commit>.json)"
+    )
+    parser.add_argument("--compare", metavar="FILE", help="compare with these results")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="slowdown reported as a regression by --compare (default 0.1)",
+    )
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.repeat, args.only)
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        name = (report["commit"] or "unknown")[:12] + (
+            "-dirty" if report["dirty"] else ""
+        )
+        output = os.path.join(RESULTS_DIR, f"{name}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, report, args.threshold):
+            sys.exit(1)
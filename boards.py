@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import os
+import re
+import threading
+import db
+import repository
+
+# Every board has its own database in BOARDS_DIR and is served under
+# /boards/<name>/. The other URLs are for the default board, the database at
+# repository.DB_PATH.
+BOARDS_DIR = os.environ.get("TAME_MANAGEMENT_BOARDS", "boards")
+PREFIX = "/boards/"
+NAME = re.compile(r"[A-Za-z0-9_-]+")
+CALLBACK_PATH = "/_dash-update-component"
+
+_migrated = set()
+_lock = threading.Lock()
+
+
+def path(name):
+    if name is None:
+        return repository.DB_PATH
+    return os.path.join(BOARDS_DIR, f"{name}.db")
+
+
+def exists(name):
+    return name is None or (NAME.fullmatch(name) and os.path.exists(path(name)))
+
+
+def create(name):
+    if not NAME.fullmatch(name):
+        raise ValueError(f"Invalid board name {name!r}")
+    os.makedirs(BOARDS_DIR, exist_ok=True)
+    with repository.use_db(path(name)):
+        db.migrate(repository.get_connection())
+
+
+def split(pathname):
+    # "/boards/team/backlog" -> ("team", "/backlog"), "/backlog" -> (None, "/backlog")
+    if pathname and pathname.startswith(PREFIX):
+        name, _, page = pathname[len(PREFIX) :].partition("/")
+        return name, "/" + page
+    return None, pathname
+
+
+def href(name, page):
+    return page if name is None else f"{PREFIX}{name}{page}"
+
+
+def from_request(request):
+    # Page loads carry the board in their path, callbacks in the url.pathname
+    # they are all sent with (see dashapp.board_callback). Callbacks write to the
+    # board, so they are never left to the Referer header, which proxies and
+    # browsers may strip: LookupError when they do not carry it. Dash's other
+    # requests (layout, dependencies) only read the app's structure and fall
+    # back to the URL of the page that sends them.
+    if request.path.startswith(PREFIX):
+        return split(request.path)[0]
+    if request.path.endswith(CALLBACK_PATH):
+        payload = request.get_json(silent=True) or {}
+        for item in payload.get("inputs", []) + payload.get("state", []):
+            if isinstance(item, dict) and (item.get("id"), item.get("property")) == (
+                "url",
+                "pathname",
+            ):
+                return split(item.get("value") or "")[0]
+        raise LookupError("Callback request without the path of its page")
+    return split(urlparse(request.referrer or "").path)[0]
+
+
+def names():
+    # The default board (None) and every board in BOARDS_DIR
+    try:
+        files = os.listdir(BOARDS_DIR)
+    except OSError:
+        files = []
+    found = [f[:-3] for f in files if f.endswith(".db") and NAME.fullmatch(f[:-3])]
+    return [None] + sorted(found)
+
+
+def _migrate(board_path):
+    if board_path not in _migrated:
+        with _lock:
+            if board_path not in _migrated:
+                db.migrate(repository.get_connection())
+                _migrated.add(board_path)
+
+
+def select(name):
+    # Points repository (and through it task_cache) to the board's database for
+    # the rest of the request, upgrading it the first time it is used
+    board_path = path(name)
+    repository.set_board_path(board_path)
+    _migrate(board_path)
+
+
+@contextmanager
+def use(name):
+    # Same as select, for code running outside of a request
+    board_path = path(name)
+    with repository.use_db(board_path):
+        _migrate(board_path)
+        yield
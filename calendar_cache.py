@@ -0,0 +1,507 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, date, timedelta
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import icalendar, requests, recurring_ical_events
+import pytz
+from requests.adapters import HTTPAdapter
+import metrics
+
+CACHE_DIR = os.environ.get("TAME_MANAGEMENT_CALENDAR_CACHE", "calendar_cache")
+TTL = int(os.environ.get("TAME_MANAGEMENT_CALENDAR_TTL", 15 * 60))  # in seconds
+FETCH_TIMEOUT = 10  # in seconds, per feed
+MAX_WORKERS = 8
+# Feeds larger than this are parsed and expanded in a separate process
+PROCESS_THRESHOLD = 1024 * 1024  # in bytes
+TIMEZONE = pytz.timezone("Europe/Berlin")
+START_OF_THE_DAY = timedelta(hours=8)
+END_OF_THE_DAY = timedelta(hours=17)
+
+# Window expanded on every download. Queries outside of it are expanded from the
+# raw feed kept next to the cache entry, without touching the network.
+WINDOW_PAST = timedelta(days=30)
+WINDOW_FUTURE = timedelta(days=365)
+
+# Expanded events are also kept in memory per feed content and window, with the
+# parsed feed, so that a query outside of the window only expands the days it
+# adds. Sizes are estimates, measured on typical feeds. The windows are written
+# next to the feed as well: background callbacks run in a new process each time,
+# which starts with the memory of the server and reads the rest from there.
+EXPANSION_BUDGET = (
+    int(os.environ.get("TAME_MANAGEMENT_EXPANSION_CACHE", 64)) * 1024 * 1024
+)  # in bytes
+WIDEN_MARGIN = timedelta(days=30)  # expanded past the query, for the next one
+INTERVAL_SIZE = 300  # in bytes, per expanded event
+PARSED_SIZE = 16  # parsed feed size per byte of ICS
+
+logger = logging.getLogger(__name__)
+
+_feeds = {}
+_lock = threading.Lock()
+_refreshing = set()
+
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_maxsize=MAX_WORKERS))
+_session.mount("https://", HTTPAdapter(pool_maxsize=MAX_WORKERS))
+_executor = ThreadPoolExecutor(MAX_WORKERS, thread_name_prefix="calendar")
+_process_executor = None
+
+
+def _after_fork():
+    # The threads of the pool and the downloads they were doing stay in the
+    # parent, a forked child (the job of a background callback) starts afresh
+    global _lock, _parsed_lock, _executor, _process_executor
+    _lock = threading.Lock()
+    _parsed_lock = threading.Lock()
+    _refreshing.clear()
+    _executor = ThreadPoolExecutor(MAX_WORKERS, thread_name_prefix="calendar")
+    _process_executor = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _path(url, extension):
+    name = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{name}.{extension}")
+
+
+def _to_datetime(value, end=False):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            return TIMEZONE.localize(value)
+        return value
+    # All-day events block the working hours of every day they cover
+    day = TIMEZONE.localize(datetime(value.year, value.month, value.day))
+    if end:
+        return day - timedelta(days=1) + END_OF_THE_DAY
+    return day + START_OF_THE_DAY
+
+
+def parse(ics):
+    return recurring_ical_events.of(icalendar.Calendar.from_ical(ics))
+
+
+def expand_parsed(query, start, end):
+    intervals = []
+    for event in query.between(start, end):
+        event_start = event["DTSTART"].dt
+        if "DTEND" in event:
+            event_end = event["DTEND"].dt
+        elif "DURATION" in event:
+            event_end = event_start + event["DURATION"].dt
+        elif isinstance(event_start, datetime):
+            event_end = event_start
+        else:
+            event_end = event_start + timedelta(days=1)
+        intervals.append(
+            (_to_datetime(event_start), _to_datetime(event_end, end=True))
+        )
+    intervals.sort()
+    return intervals
+
+
+def expand(ics, start, end):
+    return expand_parsed(parse(ics), start, end)
+
+
+@metrics.timed("ics_expand")
+def _expand(ics, start, end):
+    global _process_executor
+    if len(ics) < PROCESS_THRESHOLD:
+        return expand(ics, start, end)
+    with _lock:
+        if _process_executor is None:
+            _process_executor = ProcessPoolExecutor(max_workers=2)
+    return _process_executor.submit(expand, ics, start, end).result()
+
+
+class Expansion:
+    # The events of a feed from window[0] to window[1], sorted
+    __slots__ = ("window", "busy", "max_length", "size")
+
+    def __init__(self, window, busy):
+        self.window = window
+        self.busy = busy
+        self.max_length = max((e - s for s, e in busy), default=timedelta())
+        self.size = INTERVAL_SIZE * len(busy)
+
+    def covers(self, start, end):
+        return self.window[0] <= start and end <= self.window[1]
+
+    def gap(self, start, end):
+        # Time between the window and start to end, negative if they overlap
+        return max(start - self.window[1], self.window[0] - end)
+
+    def between(self, start, end):
+        # No event starts more than max_length before the ones that overlap start
+        first = bisect_left(self.busy, (start - self.max_length,))
+        last = bisect_left(self.busy, (end,))
+        return [(s, e) for s, e in self.busy[first:last] if e > start]
+
+
+# Least recently used first, sharing EXPANSION_BUDGET:
+# ("parsed", content hash) -> (parsed feed, size)
+# ("busy", content hash, window start) -> Expansion
+_memo = OrderedDict()
+_memo_size = 0
+_parsed_lock = threading.Lock()  # parsed feeds are shared between threads
+
+
+def _hash(ics):
+    return hashlib.sha1(ics.encode()).hexdigest()
+
+
+def _remember(key, value, size):
+    global _memo_size
+    with _lock:
+        old = _memo.pop(key, None)
+        if old is not None:
+            _memo_size -= old[1]
+        _memo[key] = (value, size)
+        _memo_size += size
+        while _memo_size > EXPANSION_BUDGET and len(_memo) > 1:
+            _, (_, evicted) = _memo.popitem(last=False)
+            _memo_size -= evicted
+
+
+def _forget(key):
+    global _memo_size
+    with _lock:
+        old = _memo.pop(key, None)
+        if old is not None:
+            _memo_size -= old[1]
+
+
+def clear():
+    # Drops the feeds and expansions held in memory, the files stay
+    global _memo_size
+    with _lock:
+        _feeds.clear()
+        _memo.clear()
+        _memo_size = 0
+
+
+def _get_parsed(key, get_ics):
+    # The parsed feed, None for the feeds expanded in a process
+    with _lock:
+        if ("parsed", key) in _memo:
+            _memo.move_to_end(("parsed", key))
+            return _memo[("parsed", key)][0], None
+    ics = get_ics()
+    if len(ics) >= PROCESS_THRESHOLD:
+        return None, ics
+    with metrics.measure("ics_expand"):
+        query = parse(ics)
+    _remember(("parsed", key), query, PARSED_SIZE * len(ics))
+    return query, ics
+
+
+def _widen(expansion, start, end, key, get_ics):
+    # Expands only the days from start to end that expansion does not cover,
+    # and WIDEN_MARGIN more in the direction it grows
+    if expansion is None:
+        window = [start, end + WIDEN_MARGIN]
+        busy, ranges = [], [window]
+    else:
+        window = list(expansion.window)
+        busy, ranges = expansion.busy, []
+        if start < window[0]:
+            ranges.append((start - WIDEN_MARGIN, window[0]))
+            window[0] = start - WIDEN_MARGIN
+        if end > window[1]:
+            ranges.append((window[1], end + WIDEN_MARGIN))
+            window[1] = end + WIDEN_MARGIN
+    query, ics = _get_parsed(key, get_ics)
+    added = []
+    for s, e in ranges:
+        if query is not None:
+            with metrics.measure("ics_expand"), _parsed_lock:
+                added += expand_parsed(query, s, e)
+        else:
+            added += _expand(ics, s, e)
+    # Events across a boundary of the old window are found on both sides of it
+    busy = sorted(set(busy).union(added)) if busy else sorted(added)
+    return Expansion(window, busy)
+
+
+def _expansions_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.expansions.json")
+
+
+def _load_expansions(key):
+    try:
+        with open(_expansions_path(key)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return [
+        Expansion(
+            [datetime.fromisoformat(d) for d in e["window"]], _deserialize(e["busy"])
+        )
+        for e in data
+    ]
+
+
+def _save_expansions(key):
+    expansions = [e for _, e in _expansions(key)]
+    data = [
+        {"window": [d.isoformat() for d in e.window], "busy": _serialize(e.busy)}
+        for e in expansions
+    ]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Several processes and threads may write it at once, the last one wins
+    tmp = f"{_expansions_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, _expansions_path(key))
+
+
+def _expansions(key):
+    with _lock:
+        return [(k, v[0]) for k, v in _memo.items() if k[0] == "busy" and k[1] == key]
+
+
+def _add_expansion(key, expansion):
+    # Unless a larger window with the same start is in memory already
+    k = ("busy", key, expansion.window[0])
+    with _lock:
+        old = _memo.get(k)
+    if old is None or old[0].window[1] < expansion.window[1]:
+        _remember(k, expansion, expansion.size)
+
+
+def _covering(expansions, start, end):
+    for k, expansion in expansions:
+        if expansion.covers(start, end):
+            with _lock:
+                if k in _memo:
+                    _memo.move_to_end(k)
+            return expansion
+    return None
+
+
+def get_expansion(key, start, end, get_ics, get_seed=None):
+    # Events of the feed whose content hashes to key, covering start to end.
+    # get_ics returns the feed if it has to be parsed, get_seed an expansion to
+    # start from when nothing is in memory for the feed. Windows near one in
+    # memory widen it, the others get their own.
+    expansions = _expansions(key)
+    if not expansions and get_seed is not None:
+        _add_expansion(key, get_seed())
+        expansions = _expansions(key)
+    expansion = _covering(expansions, start, end)
+    if expansion is None:
+        # Maybe expanded by another process
+        for expansion in _load_expansions(key):
+            _add_expansion(key, expansion)
+        expansions = _expansions(key)
+        expansion = _covering(expansions, start, end)
+    if expansion is not None:
+        return expansion
+    nearest = None
+    if expansions:
+        k, expansion = min(expansions, key=lambda e: e[1].gap(start, end))
+        # Unless the gap would cost more to expand than the window itself
+        if expansion.gap(start, end) <= end - start:
+            nearest = expansion
+            _forget(k)
+    expansion = _widen(nearest, start, end, key, get_ics)
+    _remember(("busy", key, expansion.window[0]), expansion, expansion.size)
+    _save_expansions(key)
+    return expansion
+
+
+def _serialize(intervals):
+    return [[s.isoformat(), e.isoformat()] for s, e in intervals]
+
+
+def _deserialize(intervals):
+    return [
+        (datetime.fromisoformat(s), datetime.fromisoformat(e)) for s, e in intervals
+    ]
+
+
+def load(url):
+    with _lock:
+        if url in _feeds:
+            return _feeds[url]
+    try:
+        with open(_path(url, "json")) as f:
+            feed = json.load(f)
+    except (OSError, ValueError):
+        return None
+    feed["window"] = [datetime.fromisoformat(d) for d in feed["window"]]
+    feed["busy"] = _deserialize(feed["busy"])
+    with _lock:
+        _feeds.setdefault(url, feed)
+        return _feeds[url]
+
+
+def _save(url, feed, ics=None):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if ics is not None:
+        with open(_path(url, "ics"), "w", encoding="utf-8") as f:
+            f.write(ics)
+    data = dict(
+        feed,
+        window=[d.isoformat() for d in feed["window"]],
+        busy=_serialize(feed["busy"]),
+    )
+    tmp = _path(url, "json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, _path(url, "json"))
+    with _lock:
+        _feeds[url] = feed
+
+
+def is_stale(feed):
+    return feed is None or time.time() - feed["fetched_at"] >= TTL
+
+
+def refresh(url, force=False):
+    feed = load(url)
+    if not force and not is_stale(feed):
+        return feed
+    headers = {}
+    if feed is not None:
+        if feed.get("etag"):
+            headers["If-None-Match"] = feed["etag"]
+        if feed.get("last_modified"):
+            headers["If-Modified-Since"] = feed["last_modified"]
+    try:
+        start = time.perf_counter()
+        with metrics.measure("ics_fetch"):
+            response = _session.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+        # Labelled by the name of the cache file, calendar URLs often hold a token
+        metrics.observe(
+            "tame_ics_fetch_seconds",
+            time.perf_counter() - start,
+            calendar=os.path.basename(_path(url, "json"))[:12],
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logger.warning("Could not refresh calendar %s: %s", url, e)
+        return feed
+
+    today = TIMEZONE.localize(datetime.combine(date.today(), datetime.min.time()))
+    window = [today - WINDOW_PAST, today + WINDOW_FUTURE]
+    if response.status_code == 304 and feed is not None:
+        ics = None
+        feed = dict(feed)
+        if feed["window"][1] < today + WINDOW_FUTURE / 2:
+            # The feed did not change but the expanded window is running out
+            key = feed.get("hash") or _hash(read_ics(url))
+            expansion = get_expansion(key, *window, lambda: read_ics(url))
+            feed.update(window=window, busy=expansion.between(*window), hash=key)
+    else:
+        # Servers without ETag support send the same feed again, it is then
+        # still in memory
+        ics = response.text
+        key = _hash(ics)
+        if feed is not None and feed.get("hash") not in (None, key):
+            # The windows of the previous content are of no use anymore
+            try:
+                os.remove(_expansions_path(feed["hash"]))
+            except OSError:
+                pass
+        expansion = get_expansion(key, *window, lambda: ics)
+        feed = {
+            "url": url,
+            "window": window,
+            "busy": expansion.between(*window),
+            "hash": key,
+        }
+    feed["etag"] = response.headers.get("ETag", feed.get("etag"))
+    feed["last_modified"] = response.headers.get(
+        "Last-Modified", feed.get("last_modified")
+    )
+    feed["fetched_at"] = time.time()
+    _save(url, feed, ics)
+    return feed
+
+
+def _refresh(url, force=False):
+    try:
+        return refresh(url, force)
+    finally:
+        with _lock:
+            _refreshing.discard(url)
+
+
+def refresh_async(url, force=False):
+    with _lock:
+        if url in _refreshing:
+            return None
+        _refreshing.add(url)
+    return _executor.submit(_refresh, url, force)
+
+
+def refresh_all(urls, force=False, timeout=None):
+    # Feeds still downloading after the timeout keep going in the background and
+    # are simply missing from the result
+    futures = {}
+    for url in urls:
+        future = refresh_async(url, force)
+        if future is not None:
+            futures[future] = url
+    # The downloads run in _executor, the caller only sees this wait
+    with metrics.measure("ics_fetch"):
+        _, not_done = wait(futures, timeout=timeout)
+    for future in not_done:
+        logger.warning("Calendar %s is too slow, skipping it", futures[future])
+    feeds = {}
+    for url in urls:
+        feed = load(url)
+        if feed is not None:
+            feeds[url] = feed
+    return feeds
+
+
+def read_ics(url):
+    with open(_path(url, "ics"), encoding="utf-8") as f:
+        return f.read()
+
+
+def get_busy_intervals(start, end, urls, progress=None):
+    # progress(done, total) is called as the feeds are read
+    start = _to_datetime(start)
+    end = _to_datetime(end)
+    feeds = {url: load(url) for url in urls}
+    # Nothing to serve yet for these: this is the only case that waits on the network
+    missing = [url for url, feed in feeds.items() if feed is None]
+    if missing:
+        if progress is not None:
+            progress(0, len(feeds))
+        feeds.update(refresh_all(missing, timeout=FETCH_TIMEOUT))
+
+    intervals = []
+    for done, (url, feed) in enumerate(feeds.items()):
+        if progress is not None:
+            progress(done, len(feeds))
+        if feed is None:
+            continue
+        if is_stale(feed):
+            refresh_async(url)
+
+        if "hash" not in feed:
+            # Cached before the hash was stored
+            feed["hash"] = _hash(read_ics(url))
+        expansion = get_expansion(
+            feed["hash"],
+            start,
+            end,
+            lambda: read_ics(url),
+            lambda: Expansion(feed["window"], feed["busy"]),
+        )
+        intervals += expansion.between(start, end)
+    intervals.sort()
+    return intervals
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+import math
+import numpy as np
+from availability import SLOT, localize
+import calendar_cache
+from calendar_cache import START_OF_THE_DAY, END_OF_THE_DAY
+
+PERIODS = {"day": 1, "week": 7}
+
+
+def _offset(value, origin, granularity):
+    # Wall-clock offset, so that DST changes do not shift the grid
+    return (localize(value).replace(tzinfo=None) - origin) / granularity
+
+
+def availability_bitmap(start, end, busy, granularity=SLOT, align_week=False):
+    start, end = localize(start), localize(end)
+    origin = datetime(start.year, start.month, start.day)
+    if align_week:
+        origin -= timedelta(days=origin.weekday())
+    days = (end.replace(tzinfo=None) - origin).days + 1
+    per_day = timedelta(days=1) // granularity
+
+    free = np.zeros((days, per_day), dtype=bool)
+    weekdays = (np.arange(days) + origin.weekday()) % 7 < 5
+    free[
+        weekdays,
+        math.ceil(START_OF_THE_DAY / granularity) : END_OF_THE_DAY // granularity,
+    ] = True
+    flat = free.reshape(-1)
+    flat[: max(0, math.ceil(_offset(start, origin, granularity)))] = False
+    flat[max(0, math.floor(_offset(end, origin, granularity))) :] = False
+
+    if busy:
+        # Paint every event at once: +1 where it starts, -1 where it ends, and a
+        # slot is busy wherever the running sum is positive
+        offsets = np.array(
+            [
+                (_offset(s, origin, granularity), _offset(e, origin, granularity))
+                for s, e in busy
+            ]
+        )
+        first = np.clip(np.floor(offsets[:, 0]), 0, flat.size).astype(np.intp)
+        last = np.clip(np.ceil(offsets[:, 1]), 0, flat.size).astype(np.intp)
+        keep = first < last
+        edges = np.zeros(flat.size + 1, dtype=np.int32)
+        np.add.at(edges, first[keep], 1)
+        np.add.at(edges, last[keep], -1)
+        flat &= np.cumsum(edges[:-1]) <= 0
+    return origin.date(), free
+
+
+def get_capacity(start, end, urls, period="week", granularity=SLOT, progress=None):
+    # Free hours per day, per week or per period of the given number of days
+    days_per_period = PERIODS.get(period, period)
+    busy = calendar_cache.get_busy_intervals(start, end, urls, progress)
+    origin, free = availability_bitmap(
+        start, end, busy, granularity, align_week=days_per_period == 7
+    )
+    hours = free.sum(axis=1) * (granularity / timedelta(hours=1))
+    hours = np.pad(hours, (0, -len(hours) % days_per_period))
+    totals = hours.reshape(-1, days_per_period).sum(axis=1)
+    return [
+        (origin + timedelta(days=i * days_per_period), float(total))
+        for i, total in enumerate(totals)
+    ]
@@ -1,24 +1,87 @@
+from bisect import bisect
 from datetime import datetime, date, timedelta
+from functools import lru_cache, wraps
 import math
-import sqlite3
+import os
+import uuid
 from dash import (
     Dash,
+    DiskcacheManager,
     html,
     dcc,
     Input,
     Output,
     State,
+    Patch,
     no_update,
-    callback,
     ALL,
     ctx,
 )
 import dash_bootstrap_components as dbc
-import pytz
-import icalendar, requests, recurring_ical_events
+import diskcache
+from flask import abort, request
+from availability import get_free_time
+import boards
+import capacity
+import db
+import metrics
+from metrics import callback
+import reports
+import repository
+import scheduler
+import task_cache
+
+
+RENDER_CACHE_SIZE = 4096
+
+
+def board_callback(*args, **kwargs):
+    # Same as callback, for the callbacks without the url among their inputs:
+    # the path of the page is sent with the request, which is how select_board
+    # finds the board. The function is called without it.
+    def decorator(function):
+        @wraps(function)
+        def without_pathname(*values):
+            return function(*values[:-1])
+
+        callback(*args, State("url", "pathname"), **kwargs)(without_pathname)
+        return function
+
+    return decorator
+
+
+def to_plain(value):
+    # Converts a component tree to the dicts and lists Dash sends to the browser,
+    # so that a cached tree is not walked by to_plotly_json on every response
+    if hasattr(value, "to_plotly_json"):
+        value = value.to_plotly_json()
+    if isinstance(value, dict):
+        return {k: to_plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_plain(v) for v in value]
+    return value
+
+
+@metrics.timed("render")
+def create_card(card):
+    # Keyed by today's date as well, since the color depends on it
+    return _create_card(
+        date.today(),
+        card["id"],
+        card["title"],
+        card["due_date"],
+        card["sp"],
+        card["status"],
+    )
 
 
-def create_card(card):
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _create_card(today, id, title, due_date, sp, status):
+    card = create_card_dict(id, title, due_date, sp, status)
+    return to_plain(render_card(card, today))
+
+
+def render_card(card, today):
     return dbc.Card(
         [
             dbc.CardHeader(
@@ -65,43 +128,53 @@ def create_card(card):
                 ]
             ),
         ],
-        color=compute_color(card["due_date"], card["status"]),
+        color=compute_color(card["due_date"], card["status"], today),
         inverse=True,
     )
 
 
-def compute_color(due_date, status="To Do"):
+def compute_color(due_date, status="To Do", today=None):
+    return _compute_color(due_date, status, today or date.today())
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _compute_color(due_date, status, today):
     if due_date and status != "Done":
-        due_date = strptime(due_date)
-        if due_date <= datetime.today():
+        due_date = strptime(due_date).date()
+        if due_date <= today:
             return "danger"
-        elif due_date <= datetime.today() + timedelta(days=2):
+        elif due_date <= today + timedelta(days=2):
             return "warning"
         return "success"
     else:
         return "secondary"
 
 
+STATUS_OPTIONS = to_plain(
+    [
+        {
+            "label": html.Span(["To Do"], style={"color": "black"}),
+            "value": "To Do",
+        },
+        {
+            "label": html.Span(["In Progress"], style={"color": "black"}),
+            "value": "In Progress",
+        },
+        {
+            "label": html.Span(["Blocked"], style={"color": "black"}),
+            "value": "Blocked",
+        },
+        {
+            "label": html.Span(["Done"], style={"color": "black"}),
+            "value": "Done",
+        },
+    ]
+)
+
+
 def create_dropdown(id, placeholder, *args):
     return dcc.Dropdown(
-        [
-            {
-                "label": html.Span(["To Do"], style={"color": "black"}),
-                "value": "To Do",
-            },
-            {
-                "label": html.Span(["In Progress"], style={"color": "black"}),
-                "value": "In Progress",
-            },
-            {
-                "label": html.Span(["Blocked"], style={"color": "black"}),
-                "value": "Blocked",
-            },
-            {
-                "label": html.Span(["Done"], style={"color": "black"}),
-                "value": "Done",
-            },
-        ],
+        STATUS_OPTIONS,
         placeholder=placeholder,
         id=id,
         *args,
@@ -217,7 +290,7 @@ create_card_modal = dbc.Modal(
 )
 
 
-@callback(
+@board_callback(
     Output("confirm-delete", "displayed", allow_duplicate=True),
     Output("delete_id", "data", allow_duplicate=True),
     Input("button_delete", "n_clicks"),
@@ -231,7 +304,7 @@ def delete_card(click, id):
         return False, 0
 
 
-@callback(
+@board_callback(
     Output("update_page", "data", allow_duplicate=True),
     Input("create_card_save", "n_clicks"),
     State("create_card_id", "data"),
@@ -245,27 +318,10 @@ def delete_card(click, id):
 )
 def create_card_save(n_clicks, id, *card_info):
     if id >= 0:
-        con = sqlite3.connect("tame_management.db")
-        cur = con.cursor()
-        cur.execute(
-            """UPDATE tasks 
-            SET title = ?, due_date = ?, sp = ?, description = ?, sprint = ?, status = ? 
-            WHERE id = ?""",
-            card_info + (id,),
-        )
-        con.commit()
-        con.close()
+        task_cache.update_task(id, *card_info)
         return True
     else:
-        con = sqlite3.connect("tame_management.db")
-        cur = con.cursor()
-        cur.execute(
-            """INSERT INTO tasks(title, due_date, sp, description, sprint, status)
-                    VALUES (?, ?, ?, ?, ?, ?)""",
-            card_info,
-        )
-        con.commit()
-        con.close()
+        task_cache.insert_task(*card_info)
         return True
 
 
@@ -279,41 +335,41 @@ def create_card_dict(id, title, due_date, sp, status):
     }
 
 
-def create_cards():
-    con = sqlite3.connect("tame_management.db")
-    cur = con.cursor()
-    res = cur.execute(
-        f"SELECT id, title, due_date, sp, status FROM tasks WHERE sprint = TRUE ORDER BY due_date NULLS LAST"
-    )
+def create_cards(statuses=None):
     cards = []
-    for c in res:
+    for c in task_cache.get_sprint_tasks(statuses):
         cards.append(create_card_dict(*c))
-    con.close()
     return cards
 
 
-@callback(
-    Output("update_page", "data", allow_duplicate=True),
+@board_callback(
+    Output({"type": "dashboard_column", "status": ALL}, "children"),
     Input({"type": "dropdown_card", "index": ALL, "status": ALL}, "value"),
     prevent_initial_call=True,
 )
 def move_card(new_status):
     if any(new_status):
-        new_status = list(filter(lambda item: item is not None, new_status))[0]
+        new_status = ctx.triggered[0]["value"]
         id = ctx.triggered_id["index"]
         old_status = ctx.triggered_id["status"]
         if old_status == new_status or new_status is None:
             return no_update
         else:
-            con = sqlite3.connect("tame_management.db")
-            cur = con.cursor()
-            cur.execute("UPDATE tasks SET status = ? WHERE id = ?", (new_status, id))
-            con.commit()
-            con.close()
-            return True
+            task_cache.set_task_status(id, new_status)
+            # Only the two columns the card moved between are rendered again
+            cards = create_cards([old_status, new_status])
+            return [
+                (
+                    create_column(o["id"]["status"], cards)
+                    if o["id"]["status"] in (old_status, new_status)
+                    else no_update
+                )
+                for o in ctx.outputs_list
+            ]
+    return no_update
 
 
-@callback(
+@board_callback(
     [
         Output("create_card_modal", "is_open", allow_duplicate=True),
         Output("create_card_id", "data", allow_duplicate=True),
@@ -331,50 +387,46 @@ def move_card(new_status):
 def toggle_card_modal(click, is_open):
     if any(click):
         id = ctx.triggered_id["index"]
-        con = sqlite3.connect("tame_management.db")
-        cur = con.cursor()
-        res = cur.execute(
-            "SELECT id, title, due_date, sp, description, sprint, status FROM tasks WHERE id = ?",
-            (id,),
-        ).fetchone()
-        con.close()
+        res = task_cache.get_task(id)
         return toggle_new_card(click, 0, is_open, *res)
     return no_update
 
 
-def max_length(dict):
-    output = 0
-    for key in dict:
-        output = max(output, len(dict[key]))
-    return output
+def create_column(status, cards):
+    return [html.H4(status, style={"text-align": "center"}, className="mb-4")] + [
+        html.Div(create_card(c), className="mb-4")
+        for c in cards
+        if c["status"] == status
+    ]
 
 
 def create_dashboard(cards):
-    columns = {"To Do": [], "In Progress": [], "Blocked": [], "Done": []}
-    for c in cards:
-        columns[c["status"]].append(c)
     sprint_info = get_info_sprint()
-    dashboard = [
-        html.H2(
-            f"Current Sprint: {sprint_info["sprint_start"].strftime('%b-%d')} to {sprint_info["sprint_end"].strftime('%b-%d')}"
-        ),
-        html.P(f"{(sprint_info["sprint_end"] - datetime.today()).days} days left"),
-    ]
-    for i in range(max_length(columns) + 1):
-        row = []
-        for column in columns:
-            if i == 0:
-                row.append(dbc.Col(html.H4(column), style={"text-align": "center"}))
-            else:
-                try:
-                    row.append(dbc.Col(create_card(columns[column][i - 1])))
-                except IndexError:
-                    row.append(dbc.Col())
-        dashboard.append(dbc.Row(row, className="mb-4"))
+    if sprint_info["sprint_start"] is None:
+        # A new board has no sprint yet, one is started from the backlog
+        dashboard = [html.H2("No current sprint")]
+    else:
+        dashboard = [
+            html.H2(
+                f"Current Sprint: {sprint_info["sprint_start"].strftime('%b-%d')} to {sprint_info["sprint_end"].strftime('%b-%d')}"
+            ),
+            html.P(f"{(sprint_info["sprint_end"] - datetime.today()).days} days left"),
+        ]
+    dashboard.append(
+        dbc.Row(
+            [
+                dbc.Col(
+                    create_column(status, cards),
+                    id={"type": "dashboard_column", "status": status},
+                )
+                for status in ["To Do", "In Progress", "Blocked", "Done"]
+            ]
+        )
+    )
     return dashboard
 
 
-@callback(
+@board_callback(
     [
         Output("create_card_modal", "is_open", allow_duplicate=True),
         Output("create_card_id", "data", allow_duplicate=True),
@@ -406,8 +458,26 @@ def toggle_new_card(
     return toggle, id, title, due_date, sp, description, sprint, status
 
 
-def line_backlog(id, title, due_date, duration, status, in_sprint, *args):
-    color = compute_color(due_date, status)
+@metrics.timed("render")
+def line_backlog(id, title, due_date, duration, status, in_sprint, snippet=None):
+    if snippet:
+        return render_line_backlog(
+            date.today(), id, title, due_date, duration, status, in_sprint, snippet
+        )
+    return _line_backlog(date.today(), id, title, due_date, duration, status, in_sprint)
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _line_backlog(today, id, title, due_date, duration, status, in_sprint):
+    return to_plain(
+        render_line_backlog(today, id, title, due_date, duration, status, in_sprint)
+    )
+
+
+def render_line_backlog(
+    today, id, title, due_date, duration, status, in_sprint, snippet=None
+):
+    color = compute_color(due_date, status, today)
     if color == "danger":
         color = "red"
     elif color == "success":
@@ -437,6 +507,11 @@ def line_backlog(id, title, due_date, duration, status, in_sprint, *args):
                             "margin-left": "25px",
                         },
                     ),
+                    (
+                        html.Div(snippet, style={"font-size": "12px", "color": "gray"})
+                        if snippet
+                        else None
+                    ),
                 ],
             ),
             html.Td(
@@ -462,19 +537,15 @@ def line_backlog(id, title, due_date, duration, status, in_sprint, *args):
 
 
 def get_info_sprint():
-    con = sqlite3.connect("tame_management.db")
-    cur = con.cursor()
-    res = cur.execute(
-        "SELECT name, value FROM settings WHERE name = 'sprint_start' OR name = 'sprint_end'"
-    ).fetchall()
     output = {"sprint_start": None, "sprint_end": None}
-    for r in res:
-        output[r[0]] = strptime(r[1])
-    con.close()
+    sprint = task_cache.get_current_sprint()
+    if sprint is not None:
+        output["sprint_start"] = strptime(sprint[1])
+        output["sprint_end"] = strptime(sprint[2])
     return output
 
 
-@callback(
+@board_callback(
     Output("sprint_modal", "is_open", allow_duplicate=True),
     Input("start_sprint", "n_clicks"),
     prevent_initial_call=True,
@@ -484,7 +555,7 @@ def open_start_sprint_modal(click):
         return True
 
 
-@callback(
+@board_callback(
     Output("sprint_modal", "is_open", allow_duplicate=True),
     Output("update_page", "data", allow_duplicate=True),
     Input("start_sprint_modal", "n_clicks"),
@@ -494,18 +565,7 @@ def open_start_sprint_modal(click):
 )
 def start_sprint(click, start_date, end_date):
     if click and start_date is not None and end_date is not None:
-        con = sqlite3.connect("tame_management.db")
-        cur = con.cursor()
-        cur.execute(
-            "UPDATE settings SET value = ? WHERE name = 'sprint_start'",
-            (start_date.split("T")[0],),
-        )
-        cur.execute(
-            "UPDATE settings SET value = ? WHERE name = 'sprint_end'",
-            (end_date.split("T")[0],),
-        )
-        con.commit()
-        con.close()
+        task_cache.start_sprint(start_date.split("T")[0], end_date.split("T")[0])
         return False, True
     if click:
         return True, no_update
@@ -513,13 +573,64 @@ def start_sprint(click, start_date, end_date):
         return False, no_update
 
 
+BACKLOG_PAGE_SIZE = 50
+
+
+def backlog_key(task):
+    # Sort key of a task in both tables, see repository.get_backlog_page
+    return [task[2] is None, task[2], task[0]]
+
+
+def backlog_page(after=None):
+    tasks = task_cache.get_backlog_page(after, BACKLOG_PAGE_SIZE + 1)
+    next_page = None
+    if len(tasks) > BACKLOG_PAGE_SIZE:
+        tasks = tasks[:BACKLOG_PAGE_SIZE]
+        next_page = backlog_key(tasks[-1])
+    rows = [line_backlog(*task) for task in tasks]
+    return rows, [backlog_key(task) for task in tasks], next_page
+
+
+@board_callback(
+    Output({"type": "backlog_table", "name": "backlog"}, "children"),
+    Output({"type": "backlog_keys", "name": "backlog"}, "data"),
+    Output("backlog_previous", "disabled"),
+    Output("backlog_next", "disabled"),
+    Input("backlog_previous", "n_clicks"),
+    Input("backlog_next", "n_clicks"),
+    State({"type": "backlog_keys", "name": "backlog"}, "data"),
+    prevent_initial_call=True,
+)
+def change_backlog_page(previous, next, pages):
+    # pages holds the key each visited page starts after, the next page's one and
+    # the keys of the rows currently displayed
+    starts = pages["starts"]
+    if ctx.triggered_id == "backlog_next" and pages["next"] is not None:
+        starts = starts + [pages["next"]]
+    elif ctx.triggered_id == "backlog_previous" and len(starts) > 1:
+        starts = starts[:-1]
+    else:
+        return no_update
+    rows, keys, next_page = backlog_page(starts[-1])
+    return (
+        rows,
+        {"starts": starts, "next": next_page, "keys": keys},
+        len(starts) == 1,
+        next_page is None,
+    )
+
+
+def create_sprint_points():
+    sp = {"To Do": 0, "In Progress": 0, "Blocked": 0, "Done": 0}
+    sp.update(repository.get_sprint_points())
+    text_sp = " / ".join(
+        [f"{key}: {value}" for key, value in sp.items() if key != "Done"]
+    )
+    return [text_sp + " / ", html.B(f"Total: {sum(sp.values())}")]
+
+
 def create_backlog():
-    con = sqlite3.connect("tame_management.db")
-    cur = con.cursor()
     sprint_info = get_info_sprint()
-    res = cur.execute(
-        "SELECT id, title, due_date, sp, status, sprint FROM tasks ORDER BY due_date NULLS LAST, id"
-    )
 
     table_header = [
         html.Thead(
@@ -534,23 +645,16 @@ def create_backlog():
         )
     ]
 
-    sp = {"To Do": 0, "In Progress": 0, "Blocked": 0, "Done": 0}
-    rows_sprint = []
-    rows_backlog = []
-    for task in res:
-        row = line_backlog(*task)
-        if task[5] == 1:
-            rows_sprint.append(row)
-            if task[4] != "Done":
-                sp[task[4]] += task[3]
-        else:
-            if task[4] == "Done":
-                continue
-            rows_backlog.append(row)
-    con.close()
+    sprint_tasks = task_cache.get_sprint_tasks()
+    rows_sprint = [line_backlog(*task, 1) for task in sprint_tasks]
+    rows_backlog, keys_backlog, next_page = backlog_page()
 
-    table_sprint_body = [html.Tbody(rows_sprint)]
-    table_backlog_body = [html.Tbody(rows_backlog)]
+    table_sprint_body = [
+        html.Tbody(rows_sprint, id={"type": "backlog_table", "name": "sprint"})
+    ]
+    table_backlog_body = [
+        html.Tbody(rows_backlog, id={"type": "backlog_table", "name": "backlog"})
+    ]
     table_sprint = dbc.Table(
         table_header + table_sprint_body, bordered=True, hover=True, striped=True
     )
@@ -558,10 +662,6 @@ def create_backlog():
         table_header + table_backlog_body, bordered=True, hover=True, striped=True
     )
 
-    text_sp = " / ".join(
-        [f"{key}: {value}" for key, value in sp.items() if key != "Done"]
-    )
-
     close_sprint = dbc.Button(
         "Close Sprint",
         id="close_sprint",
@@ -588,7 +688,14 @@ def create_backlog():
                             start_date=datetime.today(),
                             end_date=datetime.today() + timedelta(days=14),
                         ),
-                        html.P(id="sprint_start_notes"),
+                        html.P(
+                            [
+                                html.Span(id="sprint_start_notes"),
+                                html.Span(
+                                    id="sprint_start_progress", className="text-muted"
+                                ),
+                            ]
+                        ),
                     ]
                 )
             ),
@@ -603,17 +710,20 @@ def create_backlog():
         is_open=False,
     )
 
-    available_time = ""
+    # The hours left are filled in by update_sprint_hours_left
+    hours_left = []
     if sprint_info["sprint_start"]:
-        today = datetime.today()
-        new_hour = today.hour
-        new_minute = math.ceil(today.minute / 30) * 30
-        if new_minute >= 60:
-            new_hour += 1
-            new_minute = 0
-        today = today.replace(hour=new_hour, minute=new_minute, second=0, microsecond=0)
-        end = sprint_info["sprint_end"] + timedelta(hours=23, minutes=59)
-        available_time = f" ({get_busy_time(today, end, get_calendars()) * 0.5} left)"
+        hours_left = [
+            html.Span(id="sprint_hours_left"),
+            html.Span(
+                " (computing hours left...)",
+                id="sprint_hours_left_progress",
+                className="text-muted",
+            ),
+            dcc.Store(
+                id="sprint_end", data=sprint_info["sprint_end"].date().isoformat()
+            ),
+        ]
 
     return html.Div(
         [
@@ -623,10 +733,12 @@ def create_backlog():
                 [
                     dbc.Col(
                         [
-                            text_sp + " / ",
-                            html.B(f"Total: {sum(sp.values())}"),
-                            available_time,
-                        ],
+                            html.Span(
+                                create_sprint_points(),
+                                id={"type": "sprint_points", "name": "backlog"},
+                            ),
+                        ]
+                        + hours_left,
                         width=9,
                     ),
                     dbc.Col(
@@ -637,160 +749,161 @@ def create_backlog():
             table_sprint,
             html.H2("Backlog"),
             table_backlog,
+            dcc.Store(
+                id={"type": "backlog_keys", "name": "sprint"},
+                data={"keys": [backlog_key(task) for task in sprint_tasks]},
+            ),
+            dcc.Store(
+                id={"type": "backlog_keys", "name": "backlog"},
+                data={"starts": [None], "next": next_page, "keys": keys_backlog},
+            ),
+            dbc.Button("Previous", id="backlog_previous", disabled=True),
+            dbc.Button(
+                "Next",
+                id="backlog_next",
+                disabled=next_page is None,
+                style={"margin-left": "10px"},
+            ),
         ],
         style={"margin": "auto", "width": "90%", "margin-top": "20px"},
     )
 
 
-def get_schedule(start, end, urls):
-    schedule = {}
-
-    if end <= start:
-        return schedule
-
-    day = start
-    if day.hour < 8:
-        day = day.replace(hour=0, minute=0).astimezone(pytz.timezone("Europe/Berlin"))
-    start_of_the_day = timedelta(hours=8)
-    end_of_the_day = timedelta(hours=17)
-    delta_time = timedelta(minutes=30)
-
-    # Generate an empty calendar
-    while day <= end:
-        if day.weekday() > 4:
-            day += timedelta(days=1)
-            continue
-        day_schedule = {}
-        day_ = day.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_time = day_ + end_of_the_day
-        time = day + start_of_the_day if day.hour == 0 else day
-        while time < end_time:
-            day_schedule[(time - day_).seconds] = False
-            time += delta_time
-        schedule[day_.astimezone(pytz.timezone("Europe/Berlin"))] = day_schedule
-        day = day_ + timedelta(days=1)
-
-    # Fill in the empty calendar
-    for url in urls:
-        cal = icalendar.Calendar.from_ical(requests.get(url).text)
-        for event in recurring_ical_events.of(cal).between(start, end):
-            if not isinstance(event["DTSTART"].dt, datetime):
-                event["DTSTART"].dt = (
-                    datetime(
-                        event["DTSTART"].dt.year,
-                        event["DTSTART"].dt.month,
-                        event["DTSTART"].dt.day,
-                        0,
-                        0,
-                    ).astimezone(pytz.timezone("Europe/Berlin"))
-                    + start_of_the_day
-                )
-                event["DTEND"].dt = (
-                    datetime(
-                        event["DTEND"].dt.year,
-                        event["DTEND"].dt.month,
-                        event["DTEND"].dt.day,
-                        0,
-                        0,
-                    ).astimezone(pytz.timezone("Europe/Berlin"))
-                    - timedelta(days=1)
-                    + end_of_the_day
-                )
+def get_calendars(pathname):
+    # For the background callbacks, which run in a job process without the
+    # request: the board comes from the URL of the page
+    name, _ = boards.split(pathname)
+    if not boards.exists(name):
+        return None
+    with boards.use(name):
+        return repository.get_calendars()
 
-            duration = event["DTEND"].dt - event["DTSTART"].dt  # in seconds
-            day = datetime(
-                event["DTSTART"].dt.year,
-                event["DTSTART"].dt.month,
-                event["DTSTART"].dt.day,
-            ).astimezone(pytz.timezone("Europe/Berlin"))
-            delta_start = event["DTSTART"].dt - day
-            new_event_start = (
-                delta_start.seconds // delta_time.seconds
-            ) * delta_time.seconds
-            while timedelta(seconds=new_event_start) <= end_of_the_day:
-                schedule[day][new_event_start] = True
-                new_event_start += delta_time.seconds
-                if new_event_start >= delta_start.seconds + duration.seconds:
-                    break
-
-    return schedule
-
-
-def get_busy_time(start, end, urls):
-    schedule = get_schedule(start, end, urls)
-    free_slots = 0
-    for d in schedule.values():
-        for e in d.values():
-            if not e:
-                free_slots += 1
-    return free_slots
-
-
-def get_calendars():
-    con = sqlite3.connect("tame_management.db")
-    cur = con.cursor()
-    res = cur.execute("SELECT value FROM settings WHERE name = 'calendars'").fetchone()
-    urls = []
-    if res is not None:
-        for c in res[0].split(";"):
-            urls.append(c.split("|")[1])
-        con.close()
-    return urls
 
+def calendar_progress(set_progress):
+    def progress(done, total):
+        set_progress(f" Reading calendars ({done}/{total})...")
 
+    return progress
+
+
+def get_free_hours(set_progress, pathname, start, end):
+    calendars = get_calendars(pathname)
+    if calendars is None:
+        return None
+    return get_free_time(
+        start, end, calendars, progress=calendar_progress(set_progress)
+    )[0]
+
+
+# Both run in the background: the page renders without waiting for the
+# calendars, a new date range cancels the computation for the previous one and
+# leaving the page cancels it as well
 @callback(
     Output("sprint_start_notes", "children"),
     Input("sprint_dates_modal", "start_date"),
     Input("sprint_dates_modal", "end_date"),
     Input("start_sprint", "n_clicks"),
+    State("url", "pathname"),
+    background=True,
+    progress=Output("sprint_start_progress", "children"),
+    running=[
+        (Output("sprint_start_notes", "style"), {"display": "none"}, {}),
+        (Output("sprint_start_progress", "style"), {}, {"display": "none"}),
+    ],
+    cancel=[Input("url", "pathname")],
+    interval=500,
     prevent_initial_call=True,
 )
-def update_sprint_free_time(start, end, _):
+def update_sprint_free_time(set_progress, start, end, _, pathname):
     start = strptime(start.split("T")[0])
     end = strptime(end.split("T")[0]) + timedelta(hours=23, minutes=59)
-    free_slots = get_busy_time(start, end, get_calendars())
-    return f"Available: {free_slots * 0.5} hours"
+    free_hours = get_free_hours(set_progress, pathname, start, end)
+    if free_hours is None:
+        return no_update
+    return f"Available: {free_hours} hours"
 
 
 @callback(
+    Output("sprint_hours_left", "children"),
+    Input("sprint_end", "data"),
+    State("url", "pathname"),
+    background=True,
+    progress=Output("sprint_hours_left_progress", "children"),
+    running=[(Output("sprint_hours_left_progress", "style"), {}, {"display": "none"})],
+    cancel=[Input("url", "pathname")],
+    interval=500,
+)
+def update_sprint_hours_left(set_progress, sprint_end, pathname):
+    today = datetime.today()
+    new_hour = today.hour
+    new_minute = math.ceil(today.minute / 30) * 30
+    if new_minute >= 60:
+        new_hour += 1
+        new_minute = 0
+    today = today.replace(hour=new_hour, minute=new_minute, second=0, microsecond=0)
+    end = strptime(sprint_end) + timedelta(hours=23, minutes=59)
+    free_hours = get_free_hours(set_progress, pathname, today, end)
+    if free_hours is None:
+        return no_update
+    return f" ({free_hours} left)"
+
+
+@board_callback(
     Output("update_page", "data", allow_duplicate=True),
     Input("close_sprint", "n_clicks"),
     prevent_initial_call=True,
 )
 def close_sprint(click):
     if click:
-        con = sqlite3.connect("tame_management.db")
-        cur = con.cursor()
-        cur.execute(
-            """UPDATE tasks SET sprint = FALSE WHERE sprint = TRUE AND status = 'Done'"""
-        )
-        cur.execute(
-            """UPDATE settings SET value = NULL WHERE name = 'sprint_start' OR name = 'sprint_end'"""
-        )
-        con.commit()
-        con.close()
+        task_cache.close_sprint()
         return True
     return False
 
 
-@callback(
+SEARCH_PAGE_SIZE = 20
+
+
+def highlight(snippet):
+    # Matches are enclosed in \x02 and \x03 by repository.search_tasks
+    children = []
+    for i, part in enumerate(snippet.replace("\x03", "\x02").split("\x02")):
+        if part:
+            children.append(html.Mark(part) if i % 2 else part)
+    return children
+
+
+@board_callback(
     Output("search_result", "children"),
-    Input("searchbar", "n_submit"),
-    State("searchbar", "value"),
+    Output("search_page", "data"),
+    Output("search_previous", "disabled"),
+    Output("search_next", "disabled"),
+    Input("searchbar", "value"),
+    Input("search_previous", "n_clicks"),
+    Input("search_next", "n_clicks"),
+    State("search_page", "data"),
+    State("search_session", "data"),
     prevent_initial_call=True,
 )
-def search(_, value):
-    if value:
-        escaped_value = '"' + '" "'.join(value.split(" ")) + '"'
-        con = sqlite3.connect("tame_management.db")
-        cur = con.cursor()
-        res = cur.execute(
-            """SELECT tasks.id, tasks.title, due_date, sp, status, sprint, bm25(tasks_fts5, 0, 5, 1) as bm25
-            FROM tasks INNER JOIN tasks_fts5 on tasks.id = tasks_fts5.id 
-            WHERE tasks_fts5 MATCH (?) 
-            ORDER BY bm25""",
-            (escaped_value,),
+def search(value, previous, next, page, session):
+    if value and value.strip():
+        offset, fuzzy = 0, None
+        if ctx.triggered_id == "search_next":
+            offset, fuzzy = page["offset"] + SEARCH_PAGE_SIZE, page["fuzzy"]
+        elif ctx.triggered_id == "search_previous":
+            offset, fuzzy = max(0, page["offset"] - SEARCH_PAGE_SIZE), page["fuzzy"]
+        res, fuzzy = task_cache.search_tasks(
+            value, SEARCH_PAGE_SIZE + 1, offset, fuzzy, session
         )
+        if res is None:
+            # Superseded by a newer query while it was running
+            return no_update
+        if not res:
+            return (
+                [html.P("No task matches.")],
+                {"offset": offset, "fuzzy": fuzzy},
+                offset == 0,
+                True,
+            )
         table_header = [
             html.Thead(
                 html.Tr(
@@ -804,11 +917,21 @@ def search(_, value):
             )
         ]
         search_results = []
-        for task in res:
-            row = line_backlog(*task)
+        for task in res[:SEARCH_PAGE_SIZE]:
+            row = line_backlog(*task[:6], snippet=highlight(task[6]))
             search_results.append(row)
-        return dbc.Table(
-            table_header + [html.Tbody(search_results)], hover=True, striped=True
+        result = [
+            dbc.Table(
+                table_header + [html.Tbody(search_results)], hover=True, striped=True
+            )
+        ]
+        if fuzzy:
+            result.insert(0, html.P("No exact match, showing similar tasks."))
+        return (
+            result,
+            {"offset": offset, "fuzzy": fuzzy},
+            offset == 0,
+            len(res) <= SEARCH_PAGE_SIZE,
         )
     return no_update
 
@@ -819,13 +942,202 @@ def create_search():
         placeholder="Search for...",
         size="lg",
         autoFocus=True,
-        debounce=True,
+        debounce=0.15,
         style={"width": "95%"},
     )
     return html.Div(
         [
             searchbar,
-            html.Div(html.P("Enter a query and press 'enter'."), id="search_result"),
+            html.Div(html.P("Start typing to search."), id="search_result"),
+            dcc.Store(id="search_page", data={"offset": 0, "fuzzy": None}),
+            dcc.Store(id="search_session", data=uuid.uuid4().hex),
+            dbc.Button("Previous", id="search_previous", disabled=True),
+            dbc.Button(
+                "Next",
+                id="search_next",
+                disabled=True,
+                style={"margin-left": "10px"},
+            ),
+        ],
+        style={"margin": "auto", "width": "90%", "margin-top": "20px"},
+    )
+
+
+def create_reports():
+    today = date.today()
+    graphs = []
+    sprint_info = get_info_sprint()
+    if sprint_info["sprint_start"]:
+        days, remaining, ideal = reports.burndown(
+            sprint_info["sprint_start"].date(), sprint_info["sprint_end"].date()
+        )
+        graphs.append(
+            dcc.Graph(
+                figure={
+                    "data": [
+                        {"x": days, "y": remaining, "name": "Remaining"},
+                        {
+                            "x": days,
+                            "y": ideal,
+                            "name": "Ideal",
+                            "line": {"dash": "dash"},
+                        },
+                    ],
+                    "layout": {"title": {"text": "Burndown"}},
+                }
+            )
+        )
+
+    days, flow = reports.cumulative_flow(today - timedelta(days=90), today)
+    graphs.append(
+        dcc.Graph(
+            figure={
+                "data": [
+                    {"x": days, "y": tasks, "name": status, "stackgroup": "flow"}
+                    for status, tasks in reversed(flow.items())
+                ],
+                "layout": {"title": {"text": "Cumulative flow (tasks)"}},
+            }
+        )
+    )
+
+    sprints, committed, done = reports.velocity()
+    graphs.append(
+        dcc.Graph(
+            figure={
+                "data": [
+                    {"x": sprints, "y": committed, "type": "bar", "name": "In sprint"},
+                    {"x": sprints, "y": done, "type": "bar", "name": "Done"},
+                ],
+                "layout": {"title": {"text": "Velocity"}},
+            }
+        )
+    )
+
+    # The capacity is filled in by update_capacity, which reads the calendars
+    graphs.append(
+        html.Div(
+            [
+                html.Span(id="capacity_progress", style={"display": "none"}),
+                dcc.Graph(id="capacity_graph"),
+                dcc.Store(id="capacity_start", data=today.isoformat()),
+            ]
+        )
+    )
+    return html.Div(
+        [html.H2("Reports")] + graphs,
+        style={"margin": "auto", "width": "90%", "margin-top": "20px"},
+    )
+
+
+CAPACITY_WEEKS = 26
+
+
+@callback(
+    Output("capacity_graph", "figure"),
+    Input("capacity_start", "data"),
+    State("url", "pathname"),
+    background=True,
+    progress=Output("capacity_progress", "children"),
+    running=[(Output("capacity_progress", "style"), {}, {"display": "none"})],
+    cancel=[Input("url", "pathname")],
+    interval=500,
+)
+def update_capacity(set_progress, start, pathname):
+    calendars = get_calendars(pathname)
+    if calendars is None:
+        return no_update
+    start = strptime(start)
+    weeks = capacity.get_capacity(
+        start,
+        start + timedelta(weeks=CAPACITY_WEEKS),
+        calendars,
+        progress=calendar_progress(set_progress),
+    )
+    return {
+        "data": [
+            {
+                "x": [week for week, _ in weeks],
+                "y": [hours for _, hours in weeks],
+                "type": "bar",
+                "name": "Free hours",
+            }
+        ],
+        "layout": {"title": {"text": "Capacity (free hours per week)"}},
+    }
+
+
+def format_interval(seconds):
+    if seconds % 3600 == 0:
+        return f"every {seconds // 3600} h"
+    if seconds % 60 == 0:
+        return f"every {seconds // 60} min"
+    return f"every {seconds} s"
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%d/%m/%Y %H:%M")
+
+
+def create_jobs_table():
+    rows = []
+    for job, last in scheduler.get_status():
+        started_at, finished_at, duration, ok, message = last or (None,) * 5
+        if job.interval <= 0 or not job.enabled():
+            status, next_run = "Off", ""
+        else:
+            next_run = format_time(started_at + job.interval) if started_at else ""
+            if started_at is None:
+                status = "Not run yet"
+            elif finished_at is None or finished_at < started_at:
+                status = "Running"
+            elif ok:
+                status = "OK"
+            else:
+                status = html.Span(message, className="text-danger")
+        rows.append(
+            html.Tr(
+                [
+                    html.Td(job.title),
+                    html.Td(format_interval(job.interval) if job.interval > 0 else ""),
+                    html.Td(format_time(started_at) if started_at else ""),
+                    html.Td(f"{duration:.1f} s" if duration is not None else ""),
+                    html.Td(status),
+                    html.Td(next_run),
+                ]
+            )
+        )
+    header = html.Thead(
+        html.Tr(
+            [
+                html.Th("Job"),
+                html.Th("Runs"),
+                html.Th("Last run"),
+                html.Th("Duration"),
+                html.Th("Status"),
+                html.Th("Next run"),
+            ]
+        )
+    )
+    return dbc.Table([header, html.Tbody(rows)], bordered=True, hover=True)
+
+
+@board_callback(
+    Output("jobs_table", "children"),
+    Input("jobs_interval", "n_intervals"),
+    prevent_initial_call=True,
+)
+def update_jobs_table(_):
+    return create_jobs_table()
+
+
+def create_settings():
+    return html.Div(
+        [
+            html.H2("Settings"),
+            html.H4("Background jobs"),
+            html.Div(create_jobs_table(), id="jobs_table"),
+            dcc.Interval(id="jobs_interval", interval=30 * 1000),
         ],
         style={"margin": "auto", "width": "90%", "margin-top": "20px"},
     )
@@ -841,10 +1153,24 @@ def layout():
                         dbc.Button(
                             "New task", id=f"create_card_button", className="ms-auto"
                         ),
-                        dbc.NavLink("Current sprint", href="/", active="exact"),
-                        dbc.NavLink("Backlog", href="/backlog", active="exact"),
-                        dbc.NavLink("Search", href="/search", active="exact"),
-                        # dbc.NavLink("Settings", href="/settings", active="exact"),
+                        dbc.NavLink(
+                            "Current sprint", href="/", active="exact", id="nav_sprint"
+                        ),
+                        dbc.NavLink(
+                            "Backlog", href="/backlog", active="exact", id="nav_backlog"
+                        ),
+                        dbc.NavLink(
+                            "Search", href="/search", active="exact", id="nav_search"
+                        ),
+                        dbc.NavLink(
+                            "Reports", href="/reports", active="exact", id="nav_reports"
+                        ),
+                        dbc.NavLink(
+                            "Settings",
+                            href="/settings",
+                            active="exact",
+                            id="nav_settings",
+                        ),
                     ],
                     brand="TameManagement",
                     color="dark",
@@ -868,7 +1194,7 @@ def layout():
     ]
 
 
-@callback(
+@board_callback(
     Output("confirm-delete", "displayed", allow_duplicate=True),
     Output("delete_id", "data"),
     Input({"type": "button_delete", "index": ALL}, "n_clicks"),
@@ -881,26 +1207,74 @@ def delete_button(click):
         return False, 0
 
 
-@callback(
+@board_callback(
     Output("update_page", "data", allow_duplicate=True),
+    Output({"type": "backlog_table", "name": ALL}, "children", allow_duplicate=True),
+    Output({"type": "backlog_keys", "name": ALL}, "data", allow_duplicate=True),
+    Output({"type": "sprint_points", "name": ALL}, "children"),
     Input({"type": "button_move", "index": ALL}, "n_clicks"),
+    State({"type": "backlog_keys", "name": ALL}, "data"),
     prevent_initial_call=True,
 )
-def move_button(click):
+def move_button(click, keys):
     if any(click):
         id = ctx.triggered_id["index"]
-        con = sqlite3.connect("tame_management.db")
-        cur = con.cursor()
-        cur.execute(
-            """UPDATE tasks SET sprint = mod(sprint+1, 2) WHERE id = ?""", (id,)
+        task_cache.toggle_task_sprint(id)
+        if not keys:
+            # Not on the backlog page, e.g. in the search results
+            return True, [], [], []
+        return (no_update,) + move_backlog_row(
+            id, keys, ctx.outputs_list[1], ctx.outputs_list[2]
         )
-        con.commit()
-        con.close()
-        return True
     return no_update
 
 
-@callback(
+def move_backlog_row(id, keys, table_outputs, keys_outputs):
+    # Patch the two tables instead of rendering the page again: the row is removed
+    # from one table and inserted at its sorted position in the other one
+    keys = {o["id"]["name"]: dict(k) for o, k in zip(keys_outputs, keys)}
+    patches = {}
+    id, title, due_date, sp, _, in_sprint, status = task_cache.get_task(id)
+    key = backlog_key((id, title, due_date))
+    source, target = ("backlog", "sprint") if in_sprint else ("sprint", "backlog")
+
+    ids = [k[2] for k in keys[source]["keys"]]
+    if id in ids:
+        position = ids.index(id)
+        patches[source] = Patch()
+        del patches[source][position]
+        keys[source]["keys"] = (
+            keys[source]["keys"][:position] + keys[source]["keys"][position + 1 :]
+        )
+
+    if target == "sprint":
+        visible = True
+    else:
+        # Only if the task belongs to the backlog page being displayed
+        start, end = keys[target]["starts"][-1], keys[target]["next"]
+        visible = (
+            status != "Done"
+            and (start is None or key > start)
+            and (end is None or key < end)
+        )
+    if visible:
+        position = bisect(keys[target]["keys"], key)
+        patches[target] = Patch()
+        patches[target].insert(
+            position, line_backlog(id, title, due_date, sp, status, in_sprint)
+        )
+        keys[target]["keys"] = (
+            keys[target]["keys"][:position] + [key] + keys[target]["keys"][position:]
+        )
+
+    return (
+        [patches.get(o["id"]["name"], no_update) for o in table_outputs],
+        [keys[o["id"]["name"]] for o in keys_outputs],
+        [create_sprint_points()],
+    )
+
+
+@board_callback(
     Output("update_page", "data", allow_duplicate=True),
     Output("create_card_modal", "is_open"),
     Input("confirm-delete", "submit_n_clicks"),
@@ -910,11 +1284,7 @@ def move_button(click):
 )
 def confirm_delete(confirm_delete, cancel_delete, id):
     if confirm_delete:
-        con = sqlite3.connect("tame_management.db")
-        cur = con.cursor()
-        cur.execute("""DELETE FROM tasks WHERE id = ?""", (id,))
-        con.commit()
-        con.close()
+        task_cache.delete_task(id)
         return True, False
     return no_update
 
@@ -925,14 +1295,17 @@ def confirm_delete(confirm_delete, cancel_delete, id):
     Input("url", "pathname"),
 )
 def render_page_content(_, pathname):
+    _, pathname = boards.split(pathname)
     if pathname == "/":
         return create_dashboard(create_cards())
     elif pathname == "/backlog":
         return create_backlog()
     elif pathname == "/search":
         return create_search()
+    elif pathname == "/reports":
+        return create_reports()
     elif pathname == "/settings":
-        return html.H1("Settings")
+        return create_settings()
 
     return html.Div(
         [
@@ -944,8 +1317,72 @@ def render_page_content(_, pathname):
     )
 
 
-app = Dash(suppress_callback_exceptions=True)
-app.layout = layout
+@callback(
+    Output("nav_sprint", "href"),
+    Output("nav_backlog", "href"),
+    Output("nav_search", "href"),
+    Output("nav_reports", "href"),
+    Output("nav_settings", "href"),
+    Input("url", "pathname"),
+)
+def update_nav_links(pathname):
+    name, _ = boards.split(pathname)
+    pages = ["/", "/backlog", "/search", "/reports", "/settings"]
+    return [boards.href(name, page) for page in pages]
+
+
+db.migrate(repository.get_connection())
+task_cache.load()
+
+# Jobs of the background callbacks and their results, shared by the processes
+# serving the app
+CALLBACK_CACHE = os.environ.get("TAME_MANAGEMENT_CALLBACK_CACHE", "callback_cache")
+
+app = Dash(
+    suppress_callback_exceptions=True,
+    compress=True,
+    background_callback_manager=DiskcacheManager(diskcache.Cache(CALLBACK_CACHE)),
+)
+app.layout = metrics.instrument("layout", layout)
+server = app.server
+# Asset URLs carry the file modification time (?m=...), so browsers can keep
+# assets/bootstrap.css for a long time and still see a new version
+server.config["SEND_FILE_MAX_AGE_DEFAULT"] = 365 * 24 * 3600
+
+
+if metrics.ENABLED:
+    server.add_url_rule("/metrics", view_func=metrics.view)
+
+
+@server.before_request
+def select_board():
+    try:
+        name = boards.from_request(request)
+    except LookupError:
+        abort(400)
+    if not boards.exists(name):
+        abort(404)
+    boards.select(name)
+
+
+@server.teardown_request
+def unselect_board(_):
+    # The thread may serve other code than requests, such as the test client's
+    # caller
+    repository.set_board_path(None)
+
+
+def warm_up():
+    # Dash registers the callbacks on the first request it serves. Doing it
+    # before serving avoids concurrent first requests of a threaded server
+    # seeing them half done. Not for app.run(debug=True), which still sets up
+    # its dev tools after this.
+    server.test_client().get("/_dash-dependencies")
+
 
 if __name__ == "__main__":
+    # The reloader of debug mode serves the app from a child process it restarts
+    # on every change, the parent only watches the files
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        scheduler.start()
     app.run(debug=True)
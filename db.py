@@ -1,52 +1,529 @@
-from datetime import datetime, timedelta
-import sqlite3
-
-con = sqlite3.connect("tame_management.db")
-
-cur = con.cursor()
-cur.execute(
-    """CREATE TABLE IF NOT EXISTS tasks(
-            id INTEGER PRIMARY KEY, 
-            title TEXT NOT NULL, 
-            due_date TEXT, 
-            sp REAL, 
-            description TEXT,
+from contextlib import contextmanager
+import argparse
+import repository
+
+
+def create_schema(con):
+    con.execute(
+        """CREATE TABLE IF NOT EXISTS tasks(
+                id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                due_date TEXT,
+                sp REAL,
+                description TEXT,
+                status TEXT,
+                sprint BOOL NOT NULL)"""
+    )
+
+    con.execute(
+        """CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts5 USING fts5(id, title, description)"""
+    )
+
+    con.execute(
+        """CREATE TRIGGER IF NOT EXISTS insert_task_fts
+        AFTER INSERT on tasks
+        BEGIN
+        INSERT INTO tasks_fts5 (id, title, description) VALUES (NEW.id, NEW.title, NEW.description);
+        END;"""
+    )
+
+    con.execute(
+        """CREATE TRIGGER IF NOT EXISTS update_task_fts
+        after UPDATE on tasks
+        begin
+        UPDATE tasks_fts5 SET id = NEW.id, title = NEW.title, description = NEW.description
+        WHERE id = NEW.id;
+        end"""
+    )
+
+    con.execute(
+        """CREATE TRIGGER IF NOT EXISTS delete_task_fts
+        after DELETE on tasks
+        begin
+        DELETE FROM tasks_fts5 WHERE id = OLD.id;
+        end"""
+    )
+
+    con.execute(
+        """CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER NOT NULL PRIMARY KEY,
+            name TEXT NOT NULL,
+            value TEXT)"""
+    )
+
+
+def add_jira_key(con):
+    columns = [c[1] for c in con.execute("PRAGMA table_info(tasks)")]
+    if "jira_key" not in columns:
+        con.execute("ALTER TABLE tasks ADD COLUMN jira_key TEXT")
+    con.execute("CREATE UNIQUE INDEX IF NOT EXISTS tasks_jira_key ON tasks(jira_key)")
+
+
+def add_task_indexes(con):
+    # Covering indexes for the sprint board and the backlog. Both queries sort
+    # on "due_date IS NULL, due_date" so that the index order can be used as is.
+    con.execute(
+        """CREATE INDEX IF NOT EXISTS tasks_sprint_due_date
+        ON tasks(sprint, due_date IS NULL, due_date, id, title, sp, status)"""
+    )
+    con.execute(
+        """CREATE INDEX IF NOT EXISTS tasks_due_date
+        ON tasks(due_date IS NULL, due_date, id, title, sp, status, sprint)"""
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS tasks_sprint_status ON tasks(sprint, status)")
+    con.execute("CREATE INDEX IF NOT EXISTS settings_name ON settings(name)")
+    con.execute("ANALYZE")
+
+
+def rebuild_search_index(con):
+    # External content tables: the text is only stored in tasks and the FTS rowid
+    # is the task id, so joining back to tasks is a primary key lookup. The
+    # trigram table is only queried when the regular one finds nothing, to match
+    # words with typos.
+    for trigger in ["insert_task_fts", "update_task_fts", "delete_task_fts"]:
+        con.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    con.execute("DROP TABLE IF EXISTS tasks_fts5")
+    con.execute(
+        """CREATE VIRTUAL TABLE tasks_fts5 USING fts5(
+            title, description, content='tasks', content_rowid='id', prefix='2 3')"""
+    )
+    con.execute(
+        """CREATE VIRTUAL TABLE tasks_trigram USING fts5(
+            title, description, content='tasks', content_rowid='id', tokenize='trigram')"""
+    )
+
+    for table in ["tasks_fts5", "tasks_trigram"]:
+        con.execute(
+            f"""CREATE TRIGGER insert_{table}
+            AFTER INSERT on tasks
+            BEGIN
+            INSERT INTO {table} (rowid, title, description) VALUES (NEW.id, NEW.title, NEW.description);
+            END"""
+        )
+        con.execute(
+            f"""CREATE TRIGGER update_{table}
+            AFTER UPDATE on tasks
+            BEGIN
+            INSERT INTO {table} ({table}, rowid, title, description) VALUES ('delete', OLD.id, OLD.title, OLD.description);
+            INSERT INTO {table} (rowid, title, description) VALUES (NEW.id, NEW.title, NEW.description);
+            END"""
+        )
+        con.execute(
+            f"""CREATE TRIGGER delete_{table}
+            AFTER DELETE on tasks
+            BEGIN
+            INSERT INTO {table} ({table}, rowid, title, description) VALUES ('delete', OLD.id, OLD.title, OLD.description);
+            END"""
+        )
+        # Matches in the title weigh five times more than in the description
+        con.execute(f"INSERT INTO {table} ({table}, rank) VALUES ('rank', 'bm25(5, 1)')")
+        con.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
+
+
+def add_search_version(con):
+    # Bumped whenever the searchable text changes, cached search results are only
+    # valid for the version they were computed at
+    con.execute("CREATE TABLE search_version (version INTEGER NOT NULL)")
+    con.execute("INSERT INTO search_version VALUES (0)")
+    for event in ["INSERT", "UPDATE OF title, description", "DELETE"]:
+        name = event.split()[0].lower()
+        con.execute(
+            f"""CREATE TRIGGER {name}_search_version
+            AFTER {event} on tasks
+            BEGIN
+            UPDATE search_version SET version = version + 1;
+            END"""
+        )
+
+
+SEARCH_TABLES = ["tasks_fts5", "tasks_trigram"]
+TEXT_CHANGED = "OLD.title IS NOT NEW.title OR OLD.description IS NOT NEW.description"
+
+
+def search_triggers():
+    triggers = {}
+    for table in SEARCH_TABLES:
+        triggers[f"insert_{table}"] = f"""AFTER INSERT on tasks
+            BEGIN
+            INSERT INTO {table} (rowid, title, description) VALUES (NEW.id, NEW.title, NEW.description);
+            END"""
+        triggers[f"update_{table}"] = f"""AFTER UPDATE OF title, description on tasks
+            WHEN {TEXT_CHANGED}
+            BEGIN
+            INSERT INTO {table} ({table}, rowid, title, description) VALUES ('delete', OLD.id, OLD.title, OLD.description);
+            INSERT INTO {table} (rowid, title, description) VALUES (NEW.id, NEW.title, NEW.description);
+            END"""
+        triggers[f"delete_{table}"] = f"""AFTER DELETE on tasks
+            BEGIN
+            INSERT INTO {table} ({table}, rowid, title, description) VALUES ('delete', OLD.id, OLD.title, OLD.description);
+            END"""
+    for event, when in [
+        ("INSERT", ""),
+        ("UPDATE OF title, description", f"WHEN {TEXT_CHANGED}"),
+        ("DELETE", ""),
+    ]:
+        triggers[f"{event.split()[0].lower()}_search_version"] = f"""AFTER {event} on tasks
+            {when}
+            BEGIN
+            UPDATE search_version SET version = version + 1;
+            END"""
+    return triggers
+
+
+def create_search_triggers(con):
+    for name, trigger in search_triggers().items():
+        con.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {trigger}")
+
+
+def drop_search_triggers(con):
+    for name in search_triggers():
+        con.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+
+def rebuild_search_tables(con):
+    for table in SEARCH_TABLES:
+        con.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
+    con.execute("UPDATE search_version SET version = version + 1")
+
+
+def update_search_on_text_change(con):
+    # move_card and move_button only change status and sprint, which must not
+    # rewrite the search index
+    drop_search_triggers(con)
+    create_search_triggers(con)
+
+
+def add_sprint_metrics(con):
+    # Running totals of the tasks in the sprint per status, and one snapshot of
+    # them per day (dropped since). Kept up to date by triggers, so that
+    # from_jira.py and any other writer maintain them too.
+    con.execute(
+        """CREATE TABLE sprint_metrics (
+            status TEXT NOT NULL PRIMARY KEY,
+            sp REAL NOT NULL,
+            tasks INTEGER NOT NULL)"""
+    )
+    con.execute(
+        """CREATE TABLE sprint_metrics_daily (
+            day TEXT NOT NULL,
+            status TEXT NOT NULL,
+            sp REAL NOT NULL,
+            tasks INTEGER NOT NULL,
+            PRIMARY KEY (day, status))"""
+    )
+    con.execute(
+        """INSERT INTO sprint_metrics
+        SELECT ifnull(status, ''), total(sp), count(*) FROM tasks
+        WHERE sprint = TRUE GROUP BY 1"""
+    )
+
+    snapshot = """INSERT OR REPLACE INTO sprint_metrics_daily
+        SELECT date('now', 'localtime'), status, sp, tasks FROM sprint_metrics;"""
+    create_sprint_metrics_triggers(con, snapshot)
+    con.execute(snapshot)
+
+
+def create_sprint_metrics_triggers(con, then=""):
+    remove = """UPDATE sprint_metrics
+        SET sp = sp - ifnull(OLD.sp, 0), tasks = tasks - 1
+        WHERE OLD.sprint = TRUE AND status = ifnull(OLD.status, '');"""
+    add = """INSERT INTO sprint_metrics
+        SELECT ifnull(NEW.status, ''), ifnull(NEW.sp, 0), 1 WHERE NEW.sprint = TRUE
+        ON CONFLICT (status) DO UPDATE SET sp = sp + excluded.sp, tasks = tasks + 1;"""
+    for name, event, when, body in [
+        ("insert", "INSERT", "NEW.sprint = TRUE", add),
+        ("delete", "DELETE", "OLD.sprint = TRUE", remove),
+        (
+            "update",
+            "UPDATE OF sp, status, sprint",
+            "(OLD.sprint = TRUE OR NEW.sprint = TRUE) AND (OLD.sp IS NOT NEW.sp "
+            "OR OLD.status IS NOT NEW.status OR OLD.sprint IS NOT NEW.sprint)",
+            remove + add,
+        ),
+    ]:
+        con.execute(
+            f"""CREATE TRIGGER {name}_sprint_metrics
+            AFTER {event} ON tasks
+            WHEN {when}
+            BEGIN
+            {body}
+            {then}
+            END"""
+        )
+
+
+def add_task_events(con):
+    # Append-only log of the changes to the status, points and sprint of the
+    # tasks. Reports read task_events_daily, the net change per day of the
+    # points and tasks of every (status, sprint) pair, so that they do not have
+    # to scan the whole log.
+    con.execute(
+        """CREATE TABLE task_events (
+            id INTEGER PRIMARY KEY,
+            time TEXT NOT NULL,
+            task_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            old_status TEXT,
+            new_status TEXT,
+            old_sp REAL,
+            new_sp REAL,
+            old_sprint BOOL,
+            new_sprint BOOL)"""
+    )
+    con.execute("CREATE INDEX task_events_task_id ON task_events(task_id, time)")
+    con.execute(
+        """CREATE TABLE task_events_daily (
+            day TEXT NOT NULL,
+            status TEXT NOT NULL,
+            sprint BOOL NOT NULL,
+            sp REAL NOT NULL,
+            tasks INTEGER NOT NULL,
+            PRIMARY KEY (day, status, sprint))"""
+    )
+    con.execute(
+        """CREATE TRIGGER insert_task_events_daily
+        AFTER INSERT ON task_events
+        BEGIN
+        INSERT INTO task_events_daily
+            SELECT date(NEW.time), ifnull(NEW.old_status, ''), NEW.old_sprint,
+                -ifnull(NEW.old_sp, 0), -1
+            WHERE NEW.kind != 'insert'
+            ON CONFLICT (day, status, sprint) DO UPDATE
+            SET sp = sp + excluded.sp, tasks = tasks + excluded.tasks;
+        INSERT INTO task_events_daily
+            SELECT date(NEW.time), ifnull(NEW.new_status, ''), NEW.new_sprint,
+                ifnull(NEW.new_sp, 0), 1
+            WHERE NEW.kind != 'delete'
+            ON CONFLICT (day, status, sprint) DO UPDATE
+            SET sp = sp + excluded.sp, tasks = tasks + excluded.tasks;
+        END"""
+    )
+
+    now = "strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')"
+    old = "OLD.status, OLD.sp, OLD.sprint = TRUE"
+    new = "NEW.status, NEW.sp, NEW.sprint = TRUE"
+    for kind, event, when, values in [
+        ("insert", "INSERT", "TRUE", f"NEW.id, NULL, NULL, NULL, {new}"),
+        ("delete", "DELETE", "TRUE", f"OLD.id, {old}, NULL, NULL, NULL"),
+        (
+            "update",
+            "UPDATE OF status, sp, sprint",
+            "OLD.status IS NOT NEW.status OR OLD.sp IS NOT NEW.sp "
+            "OR OLD.sprint IS NOT NEW.sprint",
+            f"NEW.id, {old}, {new}",
+        ),
+    ]:
+        con.execute(
+            f"""CREATE TRIGGER {kind}_task_events
+            AFTER {event} ON tasks
+            WHEN {when}
+            BEGIN
+            INSERT INTO task_events (time, kind, task_id, old_status, old_sp,
+                old_sprint, new_status, new_sp, new_sprint)
+            VALUES ({now}, '{kind}', {values});
+            END"""
+        )
+    # The history starts with the tasks as they are now
+    con.execute(
+        f"""INSERT INTO task_events (time, kind, task_id, new_status, new_sp, new_sprint)
+        SELECT {now}, 'insert', id, status, sp, sprint = TRUE FROM tasks"""
+    )
+
+
+def add_sprints(con):
+    # One row per sprint instead of the sprint_start and sprint_end settings.
+    # When a sprint is closed, the points and status of each of its tasks are
+    # kept in sprint_tasks. tasks.sprint still marks the tasks of the current
+    # sprint.
+    con.execute(
+        """CREATE TABLE sprints (
+            id INTEGER PRIMARY KEY,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            closed_at TEXT)"""
+    )
+    # At most one open sprint, and finding it is a lookup in this index
+    con.execute(
+        """CREATE UNIQUE INDEX sprints_open ON sprints(closed_at IS NULL)
+        WHERE closed_at IS NULL"""
+    )
+    con.execute(
+        """CREATE TABLE sprint_tasks (
+            sprint_id INTEGER NOT NULL REFERENCES sprints(id),
+            task_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            sp REAL,
             status TEXT,
-            sprint BOOL NOT NULL)"""
-)
-
-cur.execute(
-    """CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts5 USING fts5(id, title, description)"""
-)
-
-cur.execute(
-    """CREATE TRIGGER insert_task_fts
-    AFTER INSERT on tasks
-    BEGIN
-    INSERT INTO tasks_fts5 (id, title, description) VALUES (NEW.id, NEW.title, NEW.description);
-    END;"""
-)
-
-cur.execute(
-    """CREATE TRIGGER update_task_fts
-    after UPDATE on tasks
-    begin
-    UPDATE tasks_fts5 SET id = NEW.id, title = NEW.title, description = NEW.description 
-    WHERE id = NEW.id;
-    end"""
-)
-
-cur.execute(
-    """CREATE TRIGGER delete_task_fts
-    after DELETE on tasks
-    begin
-    DELETE FROM tasks_fts5 WHERE id = OLD.id;
-    end"""
-)
-
-cur.execute(
-    """CREATE TABLE settings (
-        id INTEGER NOT NULL PRIMARY KEY,
-        name NOT NULL TEXT,
-        value TEXT)"""
-)
+            PRIMARY KEY (sprint_id, task_id))"""
+    )
+    con.execute(
+        """INSERT INTO sprints (start_date, end_date)
+        SELECT s.value, e.value FROM settings s, settings e
+        WHERE s.name = 'sprint_start' AND e.name = 'sprint_end'
+        AND s.value IS NOT NULL AND e.value IS NOT NULL
+        LIMIT 1"""
+    )
+    con.execute("DELETE FROM settings WHERE name IN ('sprint_start', 'sprint_end')")
+
+
+def add_jobs(con):
+    # Last run of each background job of scheduler.py. Jobs that must not run
+    # twice claim their run here, so that only one of several processes
+    # serving the database does it.
+    con.execute(
+        """CREATE TABLE jobs (
+            name TEXT PRIMARY KEY,
+            started_at REAL,
+            finished_at REAL,
+            duration REAL,
+            ok INTEGER,
+            message TEXT)"""
+    )
+
+
+def drop_due_date_index(con):
+    # Nothing reads tasks in due date order across sprints, the sprint board and
+    # the backlog both use tasks_sprint_due_date
+    con.execute("DROP INDEX IF EXISTS tasks_due_date")
+
+
+def drop_sprint_metrics_daily(con):
+    # The daily snapshots of add_sprint_metrics are replaced by task_events_daily,
+    # which the burndown reads. It is maintained by triggers as well, so building
+    # a report still never scans the tasks.
+    for name in ["insert", "delete", "update"]:
+        con.execute(f"DROP TRIGGER {name}_sprint_metrics")
+    create_sprint_metrics_triggers(con)
+    con.execute("DROP TABLE sprint_metrics_daily")
+
+
+# Never edit or reorder a migration that was released, append a new one instead.
+# The number of migrations applied to a database is stored in PRAGMA user_version.
+MIGRATIONS = [
+    create_schema,
+    add_jira_key,
+    add_task_indexes,
+    rebuild_search_index,
+    add_search_version,
+    update_search_on_text_change,
+    add_sprint_metrics,
+    add_task_events,
+    add_sprints,
+    add_jobs,
+    drop_due_date_index,
+    drop_sprint_metrics_daily,
+]
+
+MIGRATE_TIMEOUT = 10 * 60  # seconds
+
+
+def migrate(con):
+    # Every process serving the database calls this when it starts. BEGIN
+    # IMMEDIATE takes the write lock before user_version is read, so a process
+    # that waited for another one to migrate sees the new version and does not
+    # apply the same migration again. It may wait for a long migration, such as
+    # a rebuild of the search index, to finish.
+    timeout = con.execute("PRAGMA busy_timeout").fetchone()[0]
+    con.execute(f"PRAGMA busy_timeout = {MIGRATE_TIMEOUT * 1000}")
+    try:
+        while True:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                version = con.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    break
+                MIGRATIONS[version](con)
+                con.execute(f"PRAGMA user_version = {version + 1}")
+            except BaseException:
+                con.rollback()
+                raise
+            con.commit()
+        con.rollback()
+    finally:
+        con.execute(f"PRAGMA busy_timeout = {timeout}")
+    if is_bulk_import_interrupted(con):
+        end_bulk_import(con)
+
+
+def is_bulk_import_interrupted(con):
+    triggers = {
+        r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+    }
+    return not triggers >= search_triggers().keys()
+
+
+def start_bulk_import(con):
+    # Triggers are dropped so that the search index is rebuilt once at the end
+    # instead of row by row. If the import dies in between, the next migrate()
+    # notices the missing triggers and rebuilds the index.
+    with con:
+        drop_search_triggers(con)
+
+
+def end_bulk_import(con):
+    with con:
+        create_search_triggers(con)
+        rebuild_search_tables(con)
+
+
+@contextmanager
+def bulk_import(con):
+    start_bulk_import(con)
+    try:
+        yield con
+    finally:
+        end_bulk_import(con)
+
+
+def optimize_search_index(con, merge=None):
+    # "optimize" merges every b-tree segment into one, "merge" only does up to
+    # the given number of pages of work so it can run often on a busy database
+    with con:
+        for table in SEARCH_TABLES:
+            if merge:
+                con.execute(
+                    f"INSERT INTO {table} ({table}, rank) VALUES ('merge', ?)", (merge,)
+                )
+            else:
+                con.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize')")
+
+
+def vacuum(con):
+    # Rewrites the whole file under an exclusive lock, to be run with the app
+    # stopped. Switches the database to incremental vacuum, which the app then
+    # does a bit at a time.
+    con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    con.execute("VACUUM")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or upgrade the database")
+    parser.add_argument(
+        "--optimize", action="store_true", help="optimize the search index"
+    )
+    parser.add_argument(
+        "--merge",
+        type=int,
+        metavar="PAGES",
+        help="incrementally merge the search index, doing at most PAGES of work",
+    )
+    parser.add_argument(
+        "--vacuum",
+        action="store_true",
+        help="rebuild the database file and switch it to incremental vacuum",
+    )
+    parser.add_argument(
+        "--board", help="create or upgrade the database of this board instead"
+    )
+    args = parser.parse_args()
+    if args.board:
+        import boards
+
+        boards.create(args.board)
+        repository.set_db_path(boards.path(args.board))
+    con = repository.connect()
+    migrate(con)
+    if args.optimize or args.merge:
+        optimize_search_index(con, args.merge)
+    if args.vacuum:
+        vacuum(con)
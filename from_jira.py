@@ -1,39 +1,205 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+import argparse
+import json
+import os
 from jira import JIRA
-import sqlite3
 from tqdm import tqdm
+import boards
+import db
+import repository
 
-jiraOptions = {"server": "https://***.atlassian.net/"}
-jira = JIRA(
-    server=jiraOptions,
-    basic_auth=(
-        "***@***.***",
-        "***",
-    ),
-)
-
-issues = []
-i = 0
-while True:
-    chunk = jira.search_issues(
-        jql_str="order by created DESC", startAt=i, maxResults=50
-    )
-    issues += chunk.iterable
-    i += 50
-    if i >= chunk.total:
-        break
-
-con = sqlite3.connect("time_management.db")
-cur = con.cursor()
-for issue in tqdm(issues):
-    cur.execute(
-        "INSERT INTO tasks(title, due_date, sp, description, status, sprint) VALUES (?, ?, ?, ?, ?, ?)",
-        (
-            issue.fields.summary,
-            issue.fields.duedate,
-            issue.fields.customfield_10035,
-            issue.fields.description,
-            issue.fields.status.name,
-            False,
+PAGE_SIZE = 50
+WORKERS = 4
+FIELDS = "summary,duedate,customfield_10035,description,status,updated"
+JQL = "order by updated ASC, key ASC"
+JQL_DATE = "%Y/%m/%d %H:%M"
+# Nodes of a Jira cluster stamp issues with their own clocks, an issue can be
+# stamped a bit before the last one read
+SYNC_MARGIN = timedelta(minutes=5)
+
+
+def connect():
+    return JIRA(
+        server=os.environ.get("JIRA_SERVER", "https://***.atlassian.net/"),
+        basic_auth=(
+            os.environ.get("JIRA_USER", "***@***.***"),
+            os.environ.get("JIRA_TOKEN", "***"),
         ),
     )
-con.commit()
+
+
+def minute(issue):
+    # JQL compares dates to the minute, in the time zone of the Jira user, which
+    # is the one the API returns them in
+    return issue.fields.updated[:16].replace("-", "/").replace("T", " ")
+
+
+def _before(value, delta):
+    return (datetime.strptime(value, JQL_DATE) - delta).strftime(JQL_DATE)
+
+
+def _follows(page, overlap, expected):
+    # The issue a page overlaps with is the last one read before it
+    return (
+        overlap > 0
+        and len(page) > 0
+        and (page[0].key, page[0].fields.updated) == expected
+    )
+
+
+def fetch_pages(jira, jql, after=None, seen=None):
+    # Keyset pagination on (updated, key): a query starts at the minute of the
+    # last issue read, after the issues already read at that minute (seen, key ->
+    # updated in the order they were read) unless they were updated again. An
+    # offset alone skips issues whenever an issue before it is updated and moves
+    # to the end of the order.
+    #
+    # The pages of a query are prefetched by offset, each one with the last issue
+    # of the page before. When that issue is not the expected one, issues moved
+    # meanwhile and a new query starts from the last issue read. Yields the new
+    # position, the number of issues left and the issues not read before.
+    seen = dict(seen or {})
+    with ThreadPoolExecutor(WORKERS) as executor:
+        while True:
+            query = jql if after is None else f'updated >= "{after}" {jql}'
+
+            def fetch(start):
+                overlap = min(start, 1)
+                page = jira.search_issues(
+                    jql_str=query,
+                    startAt=start - overlap,
+                    maxResults=PAGE_SIZE + overlap,
+                    fields=FIELDS,
+                )
+                return start, page, overlap
+
+            expected = next(reversed(seen.items()), None)
+            start, page, overlap = fetch(len(seen))
+            if expected is not None and not _follows(page, overlap, expected):
+                # Issues read at that minute were updated again, read the
+                # minute from its start and skip the others
+                start, page, overlap = fetch(0)
+            starts = iter(range(start + PAGE_SIZE, page.total, PAGE_SIZE))
+            # Pages are only requested as the writer consumes them, with at most
+            # WORKERS pages in flight, so memory stays bounded
+            pending = deque(executor.submit(fetch, s) for s in islice(starts, WORKERS))
+            while True:
+                issues = page[overlap:]
+                new = []
+                for issue in issues:
+                    if minute(issue) != after:
+                        after, seen = minute(issue), {}
+                    if seen.pop(issue.key, None) != issue.fields.updated:
+                        new.append(issue)
+                    seen[issue.key] = issue.fields.updated
+                yield after, dict(seen), page.total - start - len(issues), new
+                if not pending:
+                    return
+                if issues:
+                    expected = (issues[-1].key, issues[-1].fields.updated)
+                start, page, overlap = pending.popleft().result()
+                if not _follows(page, overlap, expected):
+                    for future in pending:
+                        future.cancel()
+                    break
+                for s in islice(starts, 1):
+                    pending.append(executor.submit(fetch, s))
+
+
+def to_row(issue):
+    return (
+        issue.key,
+        issue.fields.summary,
+        issue.fields.duedate,
+        issue.fields.customfield_10035,
+        issue.fields.description,
+        issue.fields.status.name,
+    )
+
+
+def project(pages):
+    # Drop the Jira resources as soon as possible, only the fields we store are kept
+    for after, seen, left, issues in pages:
+        yield {"after": after, "seen": seen}, left, [to_row(issue) for issue in issues]
+
+
+def write_batches(con, batches, checkpoint, progress=True):
+    with tqdm(disable=not progress) as bar:
+        for position, left, rows in batches:
+            # One transaction per page, committed together with the checkpoint so
+            # an interrupted import resumes right after the last written page
+            with con:
+                con.executemany(
+                    """INSERT INTO tasks(jira_key, title, due_date, sp, description, status, sprint)
+                    VALUES (?, ?, ?, ?, ?, ?, FALSE)
+                    ON CONFLICT(jira_key) DO UPDATE SET
+                        title = excluded.title,
+                        due_date = excluded.due_date,
+                        sp = excluded.sp,
+                        description = excluded.description,
+                        status = excluded.status""",
+                    rows,
+                )
+                checkpoint.update(position)
+                repository.save_setting(
+                    con, "jira_checkpoint", json.dumps(checkpoint)
+                )
+            bar.total = bar.n + len(rows) + left
+            bar.update(len(rows))
+
+
+def sync(jira, full=False, progress=True):
+    con = repository.get_connection()
+    db.migrate(con)
+    checkpoint = repository.get_setting("jira_checkpoint")
+    checkpoint = json.loads(checkpoint) if checkpoint and not full else None
+    # Checkpoints of older versions held an offset, which is not safe to resume from
+    if checkpoint is None or "seen" not in checkpoint:
+        last_sync = repository.get_setting("jira_last_sync")
+        checkpoint = {
+            # The upsert makes reading the issues of the margin again harmless
+            "after": None if full or not last_sync else _before(last_sync, SYNC_MARGIN),
+            "seen": {},
+            # Only kept when no issue is read at all. The clock of this machine
+            # is not the one of Jira, and JQL dates are in the time zone of the
+            # Jira user, which can be up to a day ahead.
+            "started": _before(datetime.now().strftime(JQL_DATE), timedelta(days=1)),
+            "bulk": full,
+        }
+
+    # Issues updated during the import move to the end of the ascending order,
+    # so they are still picked up
+    pages = fetch_pages(jira, JQL, checkpoint["after"], checkpoint["seen"])
+    if checkpoint.get("bulk"):
+        # A full import rewrites most tasks, rebuilding the search index once at
+        # the end is cheaper than keeping it in sync row by row
+        with db.bulk_import(con):
+            write_batches(con, project(pages), checkpoint, progress)
+    else:
+        write_batches(con, project(pages), checkpoint, progress)
+    # The next sync starts from the last issue read, whose date comes from Jira
+    # in the time zone JQL uses
+    with con:
+        repository.save_setting(
+            con, "jira_last_sync", checkpoint["after"] or checkpoint["started"]
+        )
+        repository.save_setting(con, "jira_checkpoint", None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import Jira issues as tasks")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="import every issue instead of the ones updated since the last sync",
+    )
+    parser.add_argument("--board", help="import into this board instead")
+    args = parser.parse_args()
+    if args.board:
+        if not boards.exists(args.board):
+            parser.error(f"no board named {args.board}")
+        repository.set_db_path(boards.path(args.board))
+    sync(connect(), full=args.full)
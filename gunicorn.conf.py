@@ -0,0 +1,20 @@
+import os
+
+# gunicorn -c gunicorn.conf.py, for Linux hosts. serve.py does the same with
+# waitress, which also runs on Windows.
+wsgi_app = "dashapp:server"
+bind = os.environ.get("TAME_MANAGEMENT_BIND", "127.0.0.1:8050")
+workers = int(os.environ.get("TAME_MANAGEMENT_WORKERS", 2))
+threads = int(os.environ.get("TAME_MANAGEMENT_THREADS", 8))
+
+
+def post_worker_init(worker):
+    # Every worker keeps its own task cache, a write from one of them reaches the
+    # others through PRAGMA data_version. The calendar cache is shared on disk.
+    # Each worker runs the scheduler, the jobs table keeps the shared jobs from
+    # running in more than one of them.
+    from dashapp import warm_up
+    import scheduler
+
+    warm_up()
+    scheduler.start()
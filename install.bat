@@ -1,6 +1,6 @@
 python -m venv .venv
 CALL .\.venv\Scripts\activate
 python.exe -m pip install --upgrade pip
-pip install dash dash-bootstrap-components icalendar recurring_ical_events
+pip install dash[compress,diskcache] dash-bootstrap-components icalendar recurring_ical_events numpy waitress
 python db.py
 pause
\ No newline at end of file
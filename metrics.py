@@ -0,0 +1,240 @@
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+import cProfile
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Opt-in instrumentation, enabled with TAME_MANAGEMENT_METRICS=1. Timings are
+# exposed in the Prometheus text format on /metrics. With
+# TAME_MANAGEMENT_PROFILE_SLOW set to a number of seconds, every callback runs
+# under cProfile and the profile of the ones slower than that is written to
+# TAME_MANAGEMENT_PROFILE_DIR.
+ENABLED = os.environ.get("TAME_MANAGEMENT_METRICS") == "1"
+PROFILE_SLOW = float(os.environ.get("TAME_MANAGEMENT_PROFILE_SLOW", 0))
+PROFILE_DIR = os.environ.get("TAME_MANAGEMENT_PROFILE_DIR", "profiles")
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENTS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW = 1000  # latest observations the quantiles are computed from
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "recent")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=WINDOW)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantiles(self):
+        values = sorted(self.recent)
+        return [
+            (q, values[min(len(values) - 1, int(q * len(values)))]) for q in QUANTILES
+        ]
+
+
+_histograms = {}  # (name, labels) -> Histogram
+_lock = threading.Lock()
+_request = threading.local()  # phases and statements of the running callback
+
+
+def observe(name, value, buckets=SECONDS, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def _add(phase, elapsed):
+    phases = getattr(_request, "phases", None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + elapsed
+
+
+@contextmanager
+def _measure(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add(phase, time.perf_counter() - start)
+
+
+def measure(phase):
+    # Adds the time spent in the block to the phase of the running callback
+    return _measure(phase) if ENABLED else nullcontext()
+
+
+def timed(phase):
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with _measure(phase):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _profile_path(name):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(
+        PROFILE_DIR, f"{stamp}-{name}-{threading.get_ident()}.prof"
+    )
+
+
+def instrument(name, function):
+    # Records the duration of every call, the time spent in each phase and the
+    # number of SQL statements it ran
+    if not ENABLED:
+        return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        _request.phases = {}
+        _request.statements = 0
+        profile = cProfile.Profile() if PROFILE_SLOW else None
+        start = time.perf_counter()
+        try:
+            if profile is None:
+                return function(*args, **kwargs)
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            observe("tame_callback_seconds", elapsed, callback=name)
+            for phase, seconds in _request.phases.items():
+                observe(
+                    "tame_callback_phase_seconds",
+                    seconds,
+                    callback=name,
+                    phase=phase,
+                )
+            observe(
+                "tame_callback_sql_statements",
+                _request.statements,
+                STATEMENTS,
+                callback=name,
+            )
+            _request.phases = None
+            if profile is not None and elapsed >= PROFILE_SLOW:
+                path = _profile_path(name)
+                profile.dump_stats(path)
+                logger.warning(
+                    "Slow callback %s (%.3f s), see %s", name, elapsed, path
+                )
+
+    return wrapper
+
+
+def callback(*args, **kwargs):
+    # Drop-in replacement for dash.callback
+    import dash
+
+    register = dash.callback(*args, **kwargs)
+    return lambda function: register(instrument(function.__name__, function))
+
+
+class Cursor(sqlite3.Cursor):
+    def execute(self, *args):
+        _request.statements = getattr(_request, "statements", 0) + 1
+        with _measure("sql"):
+            return super().execute(*args)
+
+    def executemany(self, *args):
+        _request.statements = getattr(_request, "statements", 0) + 1
+        with _measure("sql"):
+            return super().executemany(*args)
+
+    def fetchone(self):
+        with _measure("sql"):
+            return super().fetchone()
+
+    def fetchall(self):
+        with _measure("sql"):
+            return super().fetchall()
+
+    def __next__(self):
+        with _measure("sql"):
+            return super().__next__()
+
+
+class Connection(sqlite3.Connection):
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+def connection_factory():
+    return Connection if ENABLED else sqlite3.Connection
+
+
+def _format(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render():
+    with _lock:
+        histograms = sorted(
+            (key, h.buckets, list(h.counts), h.sum, h.count, h.quantiles())
+            for key, h in _histograms.items()
+        )
+    lines = []
+    typed = set()
+    for (name, labels), buckets, counts, total, count, quantiles in histograms:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, n in zip(buckets + ("+Inf",), counts):
+            cumulative += n
+            lines.append(
+                f"{name}_bucket{_format(labels + (('le', bound),))} {cumulative}"
+            )
+        lines.append(f"{name}_sum{_format(labels)} {total}")
+        lines.append(f"{name}_count{_format(labels)} {count}")
+    typed = set()
+    for (name, labels), _, _, _, _, quantiles in histograms:
+        if name + "_quantile" not in typed:
+            typed.add(name + "_quantile")
+            lines.append(f"# TYPE {name}_quantile gauge")
+        for q, value in quantiles:
+            lines.append(
+                f"{name}_quantile{_format(labels + (('quantile', q),))} {value}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def view():
+    return render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
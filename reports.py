@@ -0,0 +1,45 @@
+from datetime import date, timedelta
+import numpy as np
+import repository
+
+STATUSES = ["To Do", "In Progress", "Blocked", "Done"]
+
+
+def daily_flow(start, end, sprint=None, tasks=False):
+    # Points (or number of tasks) in every status at the end of each day from
+    # start to end, as a days x statuses array
+    rows = repository.get_flow(start.isoformat(), end.isoformat(), sprint)
+    statuses = STATUSES + sorted(
+        {r[1] for r in rows if r[1] not in STATUSES}, key=lambda s: s or ""
+    )
+    changes = np.zeros(((end - start).days + 1, len(statuses)))
+    if rows:
+        days = np.array([(date.fromisoformat(r[0]) - start).days for r in rows])
+        columns = np.array([statuses.index(r[1]) for r in rows])
+        values = np.array([r[3] if tasks else r[2] for r in rows])
+        np.add.at(changes, (days, columns), values)
+    return statuses, np.cumsum(changes, axis=0)
+
+
+def burndown(start, end):
+    # Points left to do in the sprint each day, and the ideal straight line
+    today = min(date.today(), end)
+    statuses, flow = daily_flow(start, max(start, today), sprint=True)
+    remaining = flow[:, [s != "Done" for s in statuses]].sum(axis=1)
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    ideal = np.linspace(remaining[0] if len(remaining) else 0, 0, len(days))
+    return days, remaining[: len(days)].tolist(), ideal.tolist()
+
+
+def cumulative_flow(start, end):
+    statuses, flow = daily_flow(start, end, tasks=True)
+    days = [start + timedelta(days=i) for i in range(len(flow))]
+    return days, {s: flow[:, i].tolist() for i, s in enumerate(statuses)}
+
+
+def velocity(count=10):
+    # Points in the sprint when it was closed and points done, for the last
+    # closed sprints
+    sprints = repository.get_closed_sprints(count)
+    labels = [f"{start} to {end}" for _, start, end, _, _ in sprints]
+    return labels, [s[3] for s in sprints], [s[4] for s in sprints]
@@ -0,0 +1,480 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import os
+import re
+import sqlite3
+import threading
+import metrics
+
+DB_PATH = os.environ.get("TAME_MANAGEMENT_DB", "tame_management.db")
+
+# One connection per worker thread and database, kept open for the lifetime of
+# the thread so callbacks reuse the parsed schema and the per-connection
+# statement cache.
+_local = threading.local()
+_connections = []
+_lock = threading.Lock()
+
+# Database of the board the current request is for, DB_PATH when not set
+_board_path = ContextVar("board_path", default=None)
+
+
+def set_db_path(path):
+    global DB_PATH
+    close_all()
+    DB_PATH = path
+
+
+def db_path():
+    return _board_path.get() or DB_PATH
+
+
+def set_board_path(path):
+    _board_path.set(path)
+
+
+@contextmanager
+def use_db(path):
+    token = _board_path.set(path)
+    try:
+        yield
+    finally:
+        _board_path.reset(token)
+
+
+def connect(path=None):
+    con = sqlite3.connect(
+        path or db_path(),
+        cached_statements=256,
+        check_same_thread=False,
+        factory=metrics.connection_factory(),
+    )
+    con.execute("PRAGMA journal_mode = WAL")
+    con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA foreign_keys = ON")
+    return con
+
+
+def get_connection():
+    path = db_path()
+    connections = _local.__dict__.setdefault("connections", {})
+    con = connections.get(path)
+    if con is None:
+        con = connect(path)
+        connections[path] = con
+        with _lock:
+            _connections.append(con)
+    return con
+
+
+def close_all():
+    with _lock:
+        for con in _connections:
+            try:
+                con.close()
+            except sqlite3.ProgrammingError:
+                pass
+        _connections.clear()
+    _local.__dict__.clear()
+
+
+def _after_fork():
+    # SQLite connections must not be used across fork(). A forked child (the
+    # job of a background callback) opens its own. The inherited ones are kept
+    # referenced so that they are never closed from the child.
+    global _local, _connections, _lock
+    _inherited.append((_local, _connections))
+    _local = threading.local()
+    _connections = []
+    _lock = threading.Lock()
+
+
+_inherited = []
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def fetchall(sql, params=()):
+    return get_connection().execute(sql, params).fetchall()
+
+
+def fetchone(sql, params=()):
+    return get_connection().execute(sql, params).fetchone()
+
+
+def write(sql, params=(), con=None):
+    con = con or get_connection()
+    with con:
+        cur = con.execute(sql, params)
+    return cur
+
+
+def get_task(id, con=None):
+    con = con or get_connection()
+    return con.execute(
+        "SELECT id, title, due_date, sp, description, sprint, status FROM tasks WHERE id = ?",
+        (id,),
+    ).fetchone()
+
+
+def get_sprint_tasks(statuses=None, con=None):
+    con = con or get_connection()
+    sql = "SELECT id, title, due_date, sp, status FROM tasks WHERE sprint = TRUE"
+    params = ()
+    if statuses is not None:
+        sql += f" AND status IN ({', '.join('?' * len(statuses))})"
+        params = tuple(statuses)
+    return con.execute(
+        sql + " ORDER BY due_date IS NULL, due_date, id", params
+    ).fetchall()
+
+
+def get_backlog_page(after=None, limit=50, con=None):
+    # Keyset pagination on (due_date IS NULL, due_date, id): the page starts right
+    # after the given key, so any page costs the same as the first one. Tasks
+    # with and without a due date are read separately so that both queries are a
+    # seek in tasks_sprint_due_date.
+    con = con or get_connection()
+    is_null, due_date, id = after or (False, None, None)
+    tasks = []
+    if not is_null:
+        sql = """SELECT id, title, due_date, sp, status, sprint FROM tasks
+            WHERE sprint = FALSE AND status IS NOT 'Done' AND (due_date IS NULL) = FALSE"""
+        params = ()
+        if after is not None:
+            sql += " AND (due_date, id) > (?, ?)"
+            params = (due_date, id)
+        tasks = con.execute(
+            sql + " ORDER BY due_date, id LIMIT ?", params + (limit,)
+        ).fetchall()
+        id = None
+    if len(tasks) < limit:
+        sql = """SELECT id, title, due_date, sp, status, sprint FROM tasks
+            WHERE sprint = FALSE AND status IS NOT 'Done'
+            AND (due_date IS NULL) = TRUE AND due_date IS NULL AND id > ?"""
+        tasks += con.execute(
+            sql + " ORDER BY id LIMIT ?", (id or 0, limit - len(tasks))
+        ).fetchall()
+    return tasks
+
+
+def get_sprint_points():
+    # Maintained by the sprint_metrics triggers, see db.add_sprint_metrics
+    return dict(
+        fetchall(
+            """SELECT nullif(status, ''), sp FROM sprint_metrics
+            WHERE tasks > 0 AND status IS NOT 'Done'"""
+        )
+    )
+
+
+def get_flow(start, end, sprint=None):
+    # Net change of the points and number of tasks per day and status, see
+    # db.add_task_events. Everything before start is summed on the first day.
+    sql = """SELECT max(day, ?) AS d, nullif(status, ''), total(sp), total(tasks)
+        FROM task_events_daily WHERE day <= ?"""
+    params = (start, end)
+    if sprint is not None:
+        sql += " AND sprint = ?"
+        params += (sprint,)
+    return fetchall(sql + " GROUP BY d, status ORDER BY d", params)
+
+
+def insert_task(title, due_date, sp, description, sprint, status, con=None):
+    return write(
+        """INSERT INTO tasks(title, due_date, sp, description, sprint, status)
+        VALUES (?, ?, ?, ?, ?, ?)""",
+        (title, due_date, sp, description, sprint, status),
+        con,
+    ).lastrowid
+
+
+def update_task(id, title, due_date, sp, description, sprint, status, con=None):
+    write(
+        """UPDATE tasks
+        SET title = ?, due_date = ?, sp = ?, description = ?, sprint = ?, status = ?
+        WHERE id = ?""",
+        (title, due_date, sp, description, sprint, status, id),
+        con,
+    )
+
+
+def set_task_status(id, status, con=None):
+    write("UPDATE tasks SET status = ? WHERE id = ?", (status, id), con)
+
+
+def toggle_task_sprint(id, con=None):
+    write("UPDATE tasks SET sprint = mod(sprint+1, 2) WHERE id = ?", (id,), con)
+
+
+def delete_task(id, con=None):
+    write("DELETE FROM tasks WHERE id = ?", (id,), con)
+
+
+def _quote(word):
+    return '"' + word.replace('"', '""') + '"'
+
+
+def fts_query(value):
+    # Every word must match as a prefix, served by the prefix indexes
+    return " ".join(_quote(word) + "*" for word in value.split())
+
+
+def trigram_query(value):
+    # Any shared trigram matches, bm25 ranks first the tasks sharing the most
+    trigrams = {
+        word[i : i + 3]
+        for word in value.lower().split()
+        for i in range(len(word) - 2)
+    }
+    return " OR ".join(_quote(trigram) for trigram in sorted(trigrams))
+
+
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_RESULTS = 200  # ids kept per cached query
+
+_search_cache = OrderedDict()
+_search_cancels = OrderedDict()  # session -> event of its latest search
+_search_lock = threading.Lock()
+
+
+def _search_ids(con, value, fuzzy, version):
+    query = trigram_query(value) if fuzzy else fts_query(value)
+    if not query:
+        return [], True
+    path = db_path()
+    key = (path, value, fuzzy, version)
+    with _search_lock:
+        if key in _search_cache:
+            _search_cache.move_to_end(key)
+            return _search_cache[key]
+        # Every word is matched as a prefix, so typing more can only narrow the
+        # results of a query whose ids are all cached
+        parent = None
+        if not fuzzy:
+            for (
+                cached_path,
+                cached,
+                cached_fuzzy,
+                cached_version,
+            ), (ids, complete) in reversed(_search_cache.items()):
+                if (
+                    complete
+                    and cached_path == path
+                    and not cached_fuzzy
+                    and cached_version == version
+                    and value.startswith(cached)
+                    and (parent is None or len(ids) < len(parent))
+                ):
+                    parent = ids
+
+    table = "tasks_trigram" if fuzzy else "tasks_fts5"
+    sql = f"SELECT rowid FROM {table} WHERE {table} MATCH ?"
+    params = (query,)
+    if parent is not None:
+        sql += " AND rowid IN (SELECT value FROM json_each(?))"
+        params += (json.dumps(parent),)
+    sql += " ORDER BY rank LIMIT ?"
+    ids = [r[0] for r in con.execute(sql, params + (SEARCH_CACHE_RESULTS + 1,))]
+    result = ids[:SEARCH_CACHE_RESULTS], len(ids) <= SEARCH_CACHE_RESULTS
+
+    with _search_lock:
+        _search_cache[key] = result
+        while len(_search_cache) > SEARCH_CACHE_SIZE:
+            _search_cache.popitem(last=False)
+    return result
+
+
+def snippet(text, value, size=12):
+    # Marks the words matching the query between the \x02 and \x03 characters.
+    # Done here rather than with the FTS snippet function so that pages of cached
+    # results only need primary key lookups.
+    words = (text or "").split()
+    prefixes = tuple(value.split())
+    matches = {
+        i
+        for i, word in enumerate(words)
+        if re.sub(r"^\W+", "", word.lower()).startswith(prefixes)
+    }
+    start = 0
+    if matches:
+        start = max(0, min(min(matches) - size // 4, len(words) - size))
+    part = [
+        f"\x02{word}\x03" if start + i in matches else word
+        for i, word in enumerate(words[start : start + size])
+    ]
+    return (
+        ("… " if start > 0 else "")
+        + " ".join(part)
+        + (" …" if start + size < len(words) else "")
+    )
+
+
+def get_tasks_by_id(ids, con=None):
+    # In the order of ids, with the description last
+    con = con or get_connection()
+    res = con.execute(
+        """SELECT id, title, due_date, sp, status, sprint, description FROM tasks
+        WHERE id IN (SELECT value FROM json_each(?))""",
+        (json.dumps(ids),),
+    ).fetchall()
+    order = {id: i for i, id in enumerate(ids)}
+    return sorted(res, key=lambda task: order[task[0]])
+
+
+def _search_page(con, value, limit, offset, fuzzy, version, get_tasks):
+    ids, complete = _search_ids(con, value, fuzzy, version)
+    if complete or offset + limit <= len(ids):
+        ids = ids[offset : offset + limit]
+    else:
+        # Past the cached results, only reached by paging far into a large result
+        query, table = (
+            (trigram_query(value), "tasks_trigram")
+            if fuzzy
+            else (fts_query(value), "tasks_fts5")
+        )
+        ids = [
+            r[0]
+            for r in con.execute(
+                f"SELECT rowid FROM {table} WHERE {table} MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+                (query, limit, offset),
+            )
+        ]
+    return [
+        task[:6] + (snippet(task[6], "" if fuzzy else value),)
+        for task in get_tasks(ids)
+    ]
+
+
+def search_tasks(
+    value, limit=20, offset=0, fuzzy=None, session=None, get_tasks=get_tasks_by_id
+):
+    # A new search from the same session interrupts the previous one, which then
+    # returns None for the results
+    value = " ".join(value.lower().split())
+    cancelled = threading.Event()
+    with _search_lock:
+        previous = _search_cancels.pop(session, None)
+        if previous is not None:
+            previous.set()
+        _search_cancels[session] = cancelled
+        # Forgetting the oldest sessions does not cancel their searches
+        while len(_search_cancels) > SEARCH_CACHE_SIZE:
+            _search_cancels.popitem(last=False)
+
+    con = get_connection()
+    if session is not None:
+        con.set_progress_handler(cancelled.is_set, 1000)
+    try:
+        version = con.execute("SELECT version FROM search_version").fetchone()[0]
+        if not fuzzy:
+            res = _search_page(con, value, limit, offset, False, version, get_tasks)
+            if res or fuzzy is False or offset > 0:
+                return res, False
+        return _search_page(con, value, limit, offset, True, version, get_tasks), True
+    except sqlite3.OperationalError as e:
+        if str(e) != "interrupted":
+            raise
+        return None, fuzzy
+    finally:
+        con.set_progress_handler(None, 0)
+
+
+def get_setting(name):
+    res = fetchone("SELECT value FROM settings WHERE name = ?", (name,))
+    return res[0] if res is not None else None
+
+
+def get_settings(*names):
+    placeholders = ", ".join("?" * len(names))
+    return dict(
+        fetchall(
+            f"SELECT name, value FROM settings WHERE name IN ({placeholders})", names
+        )
+    )
+
+
+def save_setting(con, name, value):
+    # Does not commit, so that the setting can be part of a larger transaction
+    cur = con.execute("UPDATE settings SET value = ? WHERE name = ?", (value, name))
+    if cur.rowcount == 0:
+        con.execute("INSERT INTO settings(name, value) VALUES (?, ?)", (name, value))
+
+
+def set_setting(name, value):
+    con = get_connection()
+    with con:
+        save_setting(con, name, value)
+
+
+def get_calendars():
+    # The calendars setting is "name|url;name|url"
+    res = get_setting("calendars")
+    urls = []
+    if res is not None:
+        for c in res.split(";"):
+            urls.append(c.split("|")[1])
+    return urls
+
+
+def get_current_sprint(con=None):
+    con = con or get_connection()
+    return con.execute(
+        "SELECT id, start_date, end_date FROM sprints WHERE closed_at IS NULL"
+    ).fetchone()
+
+
+def start_sprint(start_date, end_date, con=None):
+    # Starting a sprint while one is open (another tab, a double click) moves
+    # the dates of the open one. The write lock is taken before looking for it,
+    # two starts at once would both find none.
+    con = con or get_connection()
+    with con:
+        con.execute("BEGIN IMMEDIATE")
+        sprint = get_current_sprint(con)
+        if sprint is None:
+            return con.execute(
+                "INSERT INTO sprints (start_date, end_date) VALUES (?, ?)",
+                (start_date, end_date),
+            ).lastrowid
+        con.execute(
+            "UPDATE sprints SET start_date = ?, end_date = ? WHERE id = ?",
+            (start_date, end_date, sprint[0]),
+        )
+        return sprint[0]
+
+
+def close_sprint(con=None):
+    con = con or get_connection()
+    with con:
+        sprint = get_current_sprint(con)
+        if sprint is not None:
+            con.execute(
+                """INSERT INTO sprint_tasks (sprint_id, task_id, title, sp, status)
+                SELECT ?, id, title, sp, status FROM tasks WHERE sprint = TRUE""",
+                (sprint[0],),
+            )
+            con.execute(
+                """UPDATE sprints SET closed_at = strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')
+                WHERE id = ?""",
+                (sprint[0],),
+            )
+        con.execute(
+            "UPDATE tasks SET sprint = FALSE WHERE sprint = TRUE AND status = 'Done'"
+        )
+
+
+def get_closed_sprints(limit=10):
+    # Most recent last, with the points committed and done in each
+    return fetchall(
+        """SELECT * FROM (
+            SELECT s.id, s.start_date, s.end_date, total(t.sp),
+                total(CASE WHEN t.status = 'Done' THEN t.sp END)
+            FROM sprints s LEFT JOIN sprint_tasks t ON t.sprint_id = s.id
+            WHERE s.closed_at IS NOT NULL
+            GROUP BY s.id ORDER BY s.start_date DESC, s.id DESC LIMIT ?)
+        ORDER BY start_date, id""",
+        (limit,),
+    )
@@ -0,0 +1,191 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+import time
+import boards
+import calendar_cache
+import db
+import repository
+
+# Periodic work done in the background of the app instead of in callbacks or
+# by hand: every job runs for every board, in a pool of worker threads.
+# TAME_MANAGEMENT_JOB_<NAME> sets the interval of a job in seconds, 0 turns it
+# off. The last run of each job is kept in the jobs table of the board's
+# database, which is what the settings page shows.
+
+TICK = 5  # seconds between two checks for due jobs
+WORKERS = 2
+SEARCH_MERGE_PAGES = 500
+VACUUM_PAGES = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def _interval(name, default):
+    return int(os.environ.get(f"TAME_MANAGEMENT_JOB_{name.upper()}", default))
+
+
+class Job:
+    # Shared jobs run once per interval whatever the number of processes serving
+    # the database, the others run in every process
+    def __init__(self, name, title, interval, run, shared=True, enabled=None):
+        self.name = name
+        self.title = title
+        self.interval = _interval(name, interval)
+        self.run = run
+        self.shared = shared
+        self.enabled = enabled or (lambda: True)
+
+
+def refresh_calendars():
+    # Every process keeps the feeds in memory, so this one is not shared
+    calendar_cache.refresh_all(repository.get_calendars())
+
+
+def is_jira_configured():
+    # Only for the boards that were imported with from_jira.py at least once
+    return bool(os.environ.get("JIRA_SERVER")) and (
+        repository.get_setting("jira_last_sync") is not None
+    )
+
+
+def sync_jira():
+    import from_jira
+
+    from_jira.sync(from_jira.connect(), progress=False)
+
+
+def merge_search_index():
+    db.optimize_search_index(repository.get_connection(), merge=SEARCH_MERGE_PAGES)
+
+
+def maintain_database():
+    con = repository.get_connection()
+    con.execute("PRAGMA optimize")
+    # A full VACUUM locks the database for as long as it takes, databases without
+    # incremental vacuum wait for `python db.py --vacuum`
+    if con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        con.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+
+
+JOBS = [
+    Job(
+        "calendars",
+        "Calendar refresh",
+        calendar_cache.TTL,
+        refresh_calendars,
+        shared=False,
+    ),
+    Job("jira_sync", "Jira sync", 15 * 60, sync_jira, enabled=is_jira_configured),
+    Job("search_index", "Search index merge", 60 * 60, merge_search_index),
+    Job("db_maintenance", "Database maintenance", 24 * 60 * 60, maintain_database),
+]
+
+
+def _claim(con, job, now):
+    with con:
+        con.execute("INSERT OR IGNORE INTO jobs (name) VALUES (?)", (job.name,))
+        # A bit of slack, the schedule of this process drifts by up to a tick
+        return con.execute(
+            """UPDATE jobs SET started_at = ?
+            WHERE name = ? AND (? OR started_at IS NULL OR started_at <= ?)""",
+            (now, job.name, not job.shared, now - job.interval + TICK),
+        ).rowcount
+
+
+def run(job):
+    # Runs the job on the database of the current board. Returns when it is due
+    # next if another process ran it recently.
+    if not job.enabled():
+        return None
+    con = repository.get_connection()
+    now = time.time()
+    if not _claim(con, job, now):
+        started_at = con.execute(
+            "SELECT started_at FROM jobs WHERE name = ?", (job.name,)
+        ).fetchone()[0]
+        return started_at + job.interval
+    start = time.perf_counter()
+    try:
+        job.run()
+        ok, message = True, None
+    except Exception as e:
+        logger.exception("Job %s failed on %s", job.name, repository.db_path())
+        ok, message = False, f"{type(e).__name__}: {e}"
+    with con:
+        con.execute(
+            """UPDATE jobs SET finished_at = ?, duration = ?, ok = ?, message = ?
+            WHERE name = ?""",
+            (time.time(), time.perf_counter() - start, ok, message, job.name),
+        )
+    return None
+
+
+def get_status():
+    # (job, (started_at, finished_at, duration, ok, message) or None) for every
+    # job, on the database of the current board
+    runs = {
+        r[0]: r[1:]
+        for r in repository.fetchall(
+            "SELECT name, started_at, finished_at, duration, ok, message FROM jobs"
+        )
+    }
+    return [(job, runs.get(job.name)) for job in JOBS]
+
+
+class Scheduler:
+    def __init__(self, jobs=JOBS, workers=WORKERS):
+        self.jobs = [job for job in jobs if job.interval > 0]
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="job")
+        self.lock = threading.Lock()
+        self.next_run = {}  # (board, job name) -> time
+        self.running = set()
+        self.stopped = threading.Event()
+
+    def _run(self, board, job):
+        key = (board, job.name)
+        try:
+            with boards.use(board):
+                next_run = run(job)
+            if next_run is not None:
+                with self.lock:
+                    self.next_run[key] = next_run
+        except Exception:
+            logger.exception("Job %s failed on board %s", job.name, board)
+        finally:
+            with self.lock:
+                self.running.discard(key)
+
+    def submit_due(self):
+        now = time.time()
+        for board in boards.names():
+            for job in self.jobs:
+                key = (board, job.name)
+                with self.lock:
+                    # A job still running when it is due again is not queued twice
+                    if key in self.running or self.next_run.get(key, 0) > now:
+                        continue
+                    self.running.add(key)
+                    self.next_run[key] = now + job.interval
+                self.executor.submit(self._run, board, job)
+
+    def loop(self):
+        while True:
+            try:
+                self.submit_due()
+            except Exception:
+                logger.exception("Scheduling jobs failed")
+            if self.stopped.wait(TICK):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def start(jobs=JOBS, workers=WORKERS):
+    scheduler = Scheduler(jobs, workers)
+    thread = threading.Thread(target=scheduler.loop, name="scheduler", daemon=True)
+    thread.start()
+    return scheduler
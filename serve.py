@@ -0,0 +1,13 @@
+import os
+from waitress import serve
+from dashapp import server, warm_up
+import scheduler
+
+HOST = os.environ.get("TAME_MANAGEMENT_HOST", "127.0.0.1")
+PORT = int(os.environ.get("TAME_MANAGEMENT_PORT", 8050))
+THREADS = int(os.environ.get("TAME_MANAGEMENT_THREADS", 8))
+
+if __name__ == "__main__":
+    warm_up()
+    scheduler.start()
+    serve(server, host=HOST, port=PORT, threads=THREADS)
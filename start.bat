@@ -1,6 +1,6 @@
 @echo off
 CALL ".\.venv\Scripts\activate"
-start "" python "dashapp.py"
+start "" python "serve.py"
 :Test
 Curl http://127.0.0.1:8050
 If "%errorlevel%" neq "0" goto :Test
@@ -0,0 +1,307 @@
+from bisect import bisect_right, insort
+import threading
+import repository
+
+# The tasks of the sprint board and of the backlog are kept in memory, so that
+# both are served without querying SQLite. They are loaded with the same
+# repository queries the pages would otherwise run, which only read the
+# covering index tasks_sprint_due_date. Descriptions and the other tasks are
+# read the first time they are needed (card modal, search results) and kept
+# too. The app writes through this module on its own connection and updates the
+# cache in place. Commits from any other connection (from_jira.py, db.py,
+# another process) change PRAGMA data_version on that connection, and the cache
+# is then loaded again.
+#
+# There is one cache, with its own connection and lock, per database, so that
+# the boards of a multi-board instance do not wait on each other.
+
+LOAD_PAGE = 1000  # backlog tasks per query when loading
+UNREAD = object()  # description not read yet
+
+
+class Task:
+    __slots__ = ("id", "title", "due_date", "sp", "description", "sprint", "status")
+
+    def __init__(self, id, title, due_date, sp, description, sprint, status):
+        self.id = id
+        self.title = title
+        self.due_date = due_date
+        self.sp = sp
+        self.description = description
+        self.sprint = sprint
+        self.status = status
+
+    def row(self):
+        return (
+            self.id,
+            self.title,
+            self.due_date,
+            self.sp,
+            self.description,
+            self.sprint,
+            self.status,
+        )
+
+    def key(self):
+        # Same order as repository.get_backlog_page
+        return (self.due_date is None, self.due_date or "", self.id)
+
+    def in_backlog(self):
+        return not self.sprint and self.status != "Done"
+
+
+class TaskCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.con = None
+        self.data_version = None
+        self.tasks = {}
+        self.by_status = {}
+        self.by_sprint = {True: set(), False: set()}
+        self.backlog = []  # sorted keys of the tasks in the backlog
+        self.sprint = None  # (id, start_date, end_date) of the open sprint
+
+    def _add(self, task):
+        self.tasks[task.id] = task
+        self.by_status.setdefault(task.status, set()).add(task.id)
+        self.by_sprint[bool(task.sprint)].add(task.id)
+
+    def _index(self, task):
+        self._add(task)
+        if task.in_backlog():
+            insort(self.backlog, task.key())
+
+    def _unindex(self, id):
+        task = self.tasks.pop(id, None)
+        if task is None:
+            return
+        self.by_status[task.status].discard(id)
+        self.by_sprint[bool(task.sprint)].discard(id)
+        if task.in_backlog():
+            del self.backlog[bisect_right(self.backlog, task.key()) - 1]
+
+    def load(self):
+        with self.lock:
+            if self.con is None:
+                self.con = repository.connect(self.path)
+            self.data_version = self.con.execute("PRAGMA data_version").fetchone()[0]
+            self.tasks.clear()
+            self.by_status.clear()
+            self.by_sprint[True].clear()
+            self.by_sprint[False].clear()
+            self.backlog.clear()
+            # A commit from another connection between these queries changes
+            # data_version, and they are run again
+            rows = repository.get_sprint_tasks(con=self.con)
+            for id, title, due_date, sp, status in rows:
+                self._add(Task(id, title, due_date, sp, UNREAD, True, status))
+            after = None
+            while True:
+                page = repository.get_backlog_page(after, LOAD_PAGE, self.con)
+                for id, title, due_date, sp, status, sprint in page:
+                    task = Task(id, title, due_date, sp, UNREAD, sprint, status)
+                    self._add(task)
+                    # Already in the order of the index
+                    self.backlog.append(task.key())
+                if len(page) < LOAD_PAGE:
+                    break
+                after = self.backlog[-1]
+            self.sprint = repository.get_current_sprint(self.con)
+
+    def _validate(self):
+        if (
+            self.con is None
+            or self.con.execute("PRAGMA data_version").fetchone()[0]
+            != self.data_version
+        ):
+            self.load()
+
+    def _refresh(self, id):
+        # Read back the written row, so that the cache holds the values as SQLite
+        # stored them (type affinity, defaults)
+        self._unindex(id)
+        row = repository.get_task(id, self.con)
+        if row is not None:
+            self._index(Task(*row))
+
+    def get_task(self, id):
+        with self.lock:
+            self._validate()
+            task = self.tasks.get(id)
+            if task is None or task.description is UNREAD:
+                self._refresh(id)
+                task = self.tasks.get(id)
+            return task.row() if task is not None else None
+
+    def get_tasks_by_id(self, ids):
+        # Same rows as repository.get_tasks_by_id, for repository.search_tasks
+        with self.lock:
+            self._validate()
+            unread = [
+                id
+                for id in ids
+                if id not in self.tasks or self.tasks[id].description is UNREAD
+            ]
+            if unread:
+                for row in repository.get_tasks_by_id(unread, self.con):
+                    id, title, due_date, sp, status, sprint, description = row
+                    self._unindex(id)
+                    self._index(
+                        Task(id, title, due_date, sp, description, sprint, status)
+                    )
+            tasks = [self.tasks[id] for id in ids if id in self.tasks]
+            return [
+                (t.id, t.title, t.due_date, t.sp, t.status, t.sprint, t.description)
+                for t in tasks
+            ]
+
+    def get_sprint_tasks(self, statuses=None):
+        with self.lock:
+            self._validate()
+            ids = self.by_sprint[True]
+            if statuses is not None:
+                ids = ids & set().union(*(self.by_status.get(s, ()) for s in statuses))
+            tasks = sorted((self.tasks[id] for id in ids), key=Task.key)
+            return [(t.id, t.title, t.due_date, t.sp, t.status) for t in tasks]
+
+    def get_backlog_page(self, after=None, limit=50):
+        with self.lock:
+            self._validate()
+            start = 0
+            if after is not None:
+                is_null, due_date, id = after
+                start = bisect_right(self.backlog, (bool(is_null), due_date or "", id))
+            tasks = [self.tasks[key[2]] for key in self.backlog[start : start + limit]]
+            return [
+                (t.id, t.title, t.due_date, t.sp, t.status, t.sprint) for t in tasks
+            ]
+
+    def get_current_sprint(self):
+        with self.lock:
+            self._validate()
+            return self.sprint
+
+    def insert_task(self, title, due_date, sp, description, sprint, status):
+        with self.lock:
+            self._validate()
+            id = repository.insert_task(
+                title, due_date, sp, description, sprint, status, con=self.con
+            )
+            self._refresh(id)
+            return id
+
+    def update_task(self, id, title, due_date, sp, description, sprint, status):
+        with self.lock:
+            self._validate()
+            repository.update_task(
+                id, title, due_date, sp, description, sprint, status, con=self.con
+            )
+            self._refresh(id)
+
+    def set_task_status(self, id, status):
+        with self.lock:
+            self._validate()
+            repository.set_task_status(id, status, con=self.con)
+            self._refresh(id)
+
+    def toggle_task_sprint(self, id):
+        with self.lock:
+            self._validate()
+            repository.toggle_task_sprint(id, con=self.con)
+            self._refresh(id)
+
+    def delete_task(self, id):
+        with self.lock:
+            self._validate()
+            repository.delete_task(id, con=self.con)
+            self._unindex(id)
+
+    def start_sprint(self, start_date, end_date):
+        with self.lock:
+            self._validate()
+            id = repository.start_sprint(start_date, end_date, con=self.con)
+            self.sprint = (id, start_date, end_date)
+
+    def close_sprint(self):
+        with self.lock:
+            self._validate()
+            done = [
+                id for id in self.by_sprint[True] if self.tasks[id].status == "Done"
+            ]
+            repository.close_sprint(con=self.con)
+            self.sprint = None
+            for id in done:
+                self._refresh(id)
+
+
+_caches = {}
+_lock = threading.Lock()
+
+
+def get_cache():
+    # The cache of the database repository.db_path() points to
+    path = repository.db_path()
+    cache = _caches.get(path)
+    if cache is None:
+        with _lock:
+            cache = _caches.setdefault(path, TaskCache(path))
+    return cache
+
+
+def load():
+    get_cache().load()
+
+
+def get_task(id):
+    return get_cache().get_task(id)
+
+
+def get_tasks_by_id(ids):
+    return get_cache().get_tasks_by_id(ids)
+
+
+def get_sprint_tasks(statuses=None):
+    return get_cache().get_sprint_tasks(statuses)
+
+
+def get_backlog_page(after=None, limit=50):
+    return get_cache().get_backlog_page(after, limit)
+
+
+def get_current_sprint():
+    return get_cache().get_current_sprint()
+
+
+def search_tasks(value, limit=20, offset=0, fuzzy=None, session=None):
+    return repository.search_tasks(
+        value, limit, offset, fuzzy, session, get_tasks=get_cache().get_tasks_by_id
+    )
+
+
+def insert_task(title, due_date, sp, description, sprint, status):
+    return get_cache().insert_task(title, due_date, sp, description, sprint, status)
+
+
+def update_task(id, title, due_date, sp, description, sprint, status):
+    get_cache().update_task(id, title, due_date, sp, description, sprint, status)
+
+
+def set_task_status(id, status):
+    get_cache().set_task_status(id, status)
+
+
+def toggle_task_sprint(id):
+    get_cache().toggle_task_sprint(id)
+
+
+def delete_task(id):
+    get_cache().delete_task(id)
+
+
+def start_sprint(start_date, end_date):
+    get_cache().start_sprint(start_date, end_date)
+
+
+def close_sprint():
+    get_cache().close_sprint()
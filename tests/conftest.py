@@ -0,0 +1,18 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import repository
+
+
+@pytest.fixture
+def con(tmp_path):
+    # A migrated database of its own for every test, used by the repository
+    repository.set_db_path(str(tmp_path / "tame_management.db"))
+    con = repository.get_connection()
+    db.migrate(con)
+    yield con
+    repository.close_all()
@@ -0,0 +1,51 @@
+from flask import Flask, request
+import pytest
+import boards
+
+app = Flask(__name__)
+
+
+def from_request(path, json=None, referrer=None):
+    headers = {"Referer": referrer} if referrer else {}
+    with app.test_request_context(path, method="POST", json=json, headers=headers):
+        return boards.from_request(request)
+
+
+def callback(pathname=None, where="state"):
+    payload = {
+        "output": "update_page.data",
+        "inputs": [{"id": "close_sprint", "property": "n_clicks", "value": 1}],
+        "state": [],
+    }
+    if pathname is not None:
+        payload[where].append({"id": "url", "property": "pathname", "value": pathname})
+    return payload
+
+
+def test_page_loads():
+    assert from_request("/boards/team/backlog") == "team"
+    assert from_request("/backlog") is None
+
+
+def test_callbacks_use_the_pathname_they_carry():
+    path = "/_dash-update-component"
+    assert from_request(path, callback("/boards/team/backlog")) == "team"
+    assert from_request(path, callback("/boards/team/", "inputs")) == "team"
+    assert from_request(path, callback("/backlog")) is None
+    # Not the Referer, even when there is one
+    referrer = "http://localhost/boards/other/backlog"
+    assert from_request(path, callback("/boards/team/"), referrer) == "team"
+
+
+def test_callbacks_without_a_pathname_are_rejected():
+    referrer = "http://localhost/boards/team/backlog"
+    with pytest.raises(LookupError):
+        from_request("/_dash-update-component", callback(), referrer)
+    with pytest.raises(LookupError):
+        from_request("/_dash-update-component", callback())
+
+
+def test_other_dash_requests_use_the_referrer():
+    referrer = "http://localhost/boards/team/backlog"
+    assert from_request("/_dash-layout", referrer=referrer) == "team"
+    assert from_request("/_dash-layout") is None
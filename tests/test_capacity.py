@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+import random
+import pytest
+import availability
+import calendar_cache
+import capacity
+from calendar_cache import TIMEZONE
+
+
+def busy_intervals(start, days, count, seed=0):
+    # Meetings of any length at any minute, overlapping each other at times
+    rng = random.Random(seed)
+    intervals = []
+    for _ in range(count):
+        begin = start + timedelta(minutes=rng.randrange(days * 24 * 60))
+        intervals.append((begin, begin + timedelta(minutes=rng.randrange(5, 300))))
+    return sorted(intervals)
+
+
+@pytest.mark.parametrize(
+    "start",
+    [
+        datetime(2026, 1, 5),
+        # Both DST changes fall in the range
+        datetime(2026, 3, 2),
+        datetime(2026, 10, 5),
+    ],
+)
+def test_capacity_matches_free_time(monkeypatch, start):
+    start = TIMEZONE.localize(start)
+    weeks = 8
+    busy = busy_intervals(start, weeks * 7, 300)
+    monkeypatch.setattr(
+        calendar_cache, "get_busy_intervals", lambda *args, **kwargs: busy
+    )
+    end = availability.localize(start.replace(tzinfo=None) + timedelta(weeks=weeks))
+    result = capacity.get_capacity(start, end, ["calendar"])
+
+    expected = []
+    for week in range(weeks + 1):
+        week_start = availability.localize(
+            start.replace(tzinfo=None) + timedelta(weeks=week)
+        )
+        week_end = min(
+            end, availability.localize(week_start.replace(tzinfo=None) + timedelta(7))
+        )
+        hours, _ = availability.get_free_time(week_start, week_end, ["calendar"])
+        expected.append((week_start.date(), hours))
+    assert result == expected
+
+
+def test_capacity_of_a_partial_week(monkeypatch):
+    # A start on a Wednesday afternoon counts from there, in the week of Monday
+    monkeypatch.setattr(calendar_cache, "get_busy_intervals", lambda *a, **k: [])
+    start = TIMEZONE.localize(datetime(2026, 1, 7, 12))
+    end = TIMEZONE.localize(datetime(2026, 1, 14, 12))
+    hours, _ = availability.get_free_time(start, end, ["calendar"])
+    result = capacity.get_capacity(start, end, ["calendar"])
+    assert [week for week, _ in result] == [
+        datetime(2026, 1, 5).date(),
+        datetime(2026, 1, 12).date(),
+    ]
+    assert sum(h for _, h in result) == hours == 5 + 9 * 4 + 4
@@ -0,0 +1,129 @@
+import re
+from datetime import date, timedelta
+import db
+import reports
+import repository
+
+
+def add_tasks(con, count=200):
+    with con:
+        con.executemany(
+            """INSERT INTO tasks (title, due_date, sp, description, sprint, status)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            [
+                (
+                    f"Task {i}",
+                    None if i % 3 == 0 else f"2024-{i % 12 + 1:02}-{i % 28 + 1:02}",
+                    i % 8,
+                    "Description",
+                    i % 5 == 0,
+                    ["Backlog", "In Progress", "Done"][i % 3],
+                )
+                for i in range(count)
+            ],
+        )
+        con.execute("ANALYZE")
+
+
+def query_plans(con, read):
+    # Plans of the statements the read runs, with their parameters bound
+    statements = []
+    con.set_trace_callback(statements.append)
+    try:
+        read()
+    finally:
+        con.set_trace_callback(None)
+    assert statements
+    return [
+        " | ".join(r[3] for r in con.execute("EXPLAIN QUERY PLAN " + sql))
+        for sql in statements
+    ]
+
+
+def test_migrate_is_idempotent(con):
+    db.migrate(con)
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    assert version == len(db.MIGRATIONS)
+
+
+def test_sprint_board_uses_covering_index(con):
+    add_tasks(con)
+    for statuses in [None, ["Backlog", "In Progress"]]:
+        for plan in query_plans(con, lambda: repository.get_sprint_tasks(statuses)):
+            assert "USING COVERING INDEX tasks_sprint_due_date" in plan
+            assert "TEMP B-TREE" not in plan
+
+
+def test_backlog_uses_covering_index(con):
+    add_tasks(con)
+    for after in [None, (False, "2024-06-01", 10), (True, None, 30)]:
+        for plan in query_plans(con, lambda: repository.get_backlog_page(after, 20)):
+            assert "USING COVERING INDEX tasks_sprint_due_date" in plan
+            assert "TEMP B-TREE" not in plan
+
+
+def test_due_date_index_is_dropped(con):
+    indexes = {
+        r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+    assert "tasks_sprint_due_date" in indexes
+    assert "tasks_due_date" not in indexes
+
+
+def test_sprint_metrics_without_daily_snapshots(tmp_path):
+    # A database created before the snapshots were dropped
+    con = repository.connect(str(tmp_path / "old.db"))
+    for version, migration in enumerate(db.MIGRATIONS[:-1], 1):
+        with con:
+            migration(con)
+            con.execute(f"PRAGMA user_version = {version}")
+    add_tasks(con)
+    db.migrate(con)
+    tables = {r[0] for r in con.execute("SELECT name FROM sqlite_master")}
+    assert "sprint_metrics_daily" not in tables
+    with con:
+        con.execute("UPDATE tasks SET status = 'Done' WHERE id % 7 = 0")
+        con.execute("UPDATE tasks SET sprint = NOT sprint WHERE id % 11 = 0")
+        con.execute("DELETE FROM tasks WHERE id % 13 = 0")
+    expected = con.execute("""SELECT ifnull(status, ''), total(sp), count(*) FROM tasks
+        WHERE sprint = TRUE GROUP BY 1 ORDER BY 1""").fetchall()
+    metrics = con.execute(
+        "SELECT status, sp, tasks FROM sprint_metrics WHERE tasks > 0 ORDER BY 1"
+    ).fetchall()
+    assert metrics == expected
+
+
+def test_maintenance_leaves_vacuum_to_the_cli(con):
+    import scheduler
+
+    add_tasks(con)
+    with con:
+        con.execute("DELETE FROM tasks")
+    scheduler.maintain_database()
+    assert con.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+    db.vacuum(con)
+    assert con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert con.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    scheduler.maintain_database()
+
+
+def test_burndown_does_not_scan_tasks(con):
+    add_tasks(con)
+    with con:
+        con.execute("UPDATE tasks SET status = 'Done' WHERE id % 5 = 0")
+    today = date.today()
+    days = []
+    plans = query_plans(
+        con,
+        lambda: days.append(
+            reports.burndown(today - timedelta(days=3), today + timedelta(days=3))
+        ),
+    )
+    assert not any(re.search(r"\btasks\b", plan) for plan in plans)
+    _, remaining, _ = days[0]
+    assert (
+        remaining[-1]
+        == con.execute(
+            "SELECT total(sp) FROM tasks WHERE sprint = TRUE AND status != 'Done'"
+        ).fetchone()[0]
+    )
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import threading
+import pytest
+
+pytest.importorskip("jira")
+import from_jira
+import repository
+
+
+class Page(list):
+    total = 0
+
+
+class FakeJira:
+    # Issues ordered by (updated, key) like the JQL of from_jira.sync, 30 per
+    # minute. on_search is called before every search with the number of
+    # searches done so far.
+    def __init__(self, count, on_search=None):
+        self.issues = {}
+        self.time = datetime(2024, 1, 1)
+        self.searches = 0
+        self.on_search = on_search
+        self.lock = threading.Lock()
+        for i in range(count):
+            self.update(f"T-{i:04}")
+
+    def update(self, key):
+        self.time += timedelta(seconds=2)
+        self.issues[key] = SimpleNamespace(
+            key=key,
+            fields=SimpleNamespace(
+                summary=f"{key} {self.time}",
+                duedate=None,
+                customfield_10035=1,
+                description=None,
+                status=SimpleNamespace(name="To Do"),
+                updated=self.time.strftime("%Y-%m-%dT%H:%M:%S.000+0000"),
+            ),
+        )
+
+    def search_issues(self, jql_str, startAt, maxResults, fields):
+        with self.lock:
+            self.searches += 1
+            if self.on_search is not None:
+                self.on_search(self, self.searches)
+            issues = sorted(
+                self.issues.values(),
+                key=lambda issue: (issue.fields.updated, issue.key),
+            )
+        if jql_str.startswith("updated >= "):
+            after = jql_str.split('"')[1]
+            issues = [issue for issue in issues if from_jira.minute(issue) >= after]
+        page = Page(issues[startAt : startAt + maxResults])
+        page.total = len(issues)
+        return page
+
+
+@pytest.fixture(autouse=True)
+def small_pages(monkeypatch):
+    monkeypatch.setattr(from_jira, "PAGE_SIZE", 10)
+
+
+def imported(con):
+    return dict(con.execute("SELECT jira_key, title FROM tasks"))
+
+
+def expected(jira):
+    return {key: issue.fields.summary for key, issue in jira.issues.items()}
+
+
+def test_full_import(con):
+    jira = FakeJira(95)
+    from_jira.sync(jira, full=True, progress=False)
+    assert imported(con) == expected(jira)
+
+
+def test_issues_updated_during_the_import(con):
+    # Issues already read move to the end of the order, which shifts every
+    # page after them by one
+    def on_search(jira, searches):
+        if searches in (2, 4, 6):
+            jira.update(f"T-{searches:04}")
+
+    jira = FakeJira(95, on_search)
+    from_jira.sync(jira, full=True, progress=False)
+    assert imported(con) == expected(jira)
+
+
+def test_resume_after_interruption(con):
+    def on_search(jira, searches):
+        if searches == 4:
+            jira.update("T-0001")
+            jira.update("T-0035")
+            raise ConnectionError
+
+    jira = FakeJira(95, on_search)
+    with pytest.raises(ConnectionError):
+        from_jira.sync(jira, full=True, progress=False)
+    assert repository.get_setting("jira_checkpoint") is not None
+    searches = jira.searches
+    from_jira.sync(jira, progress=False)
+    assert imported(con) == expected(jira)
+    # Resumed from the checkpoint instead of starting over
+    assert jira.searches - searches < 95 // from_jira.PAGE_SIZE
+
+
+def test_incremental_sync(con):
+    jira = FakeJira(95)
+    from_jira.sync(jira, full=True, progress=False)
+    # The clock of the fake Jira is years behind this machine
+    for i in range(0, 95, 7):
+        jira.update(f"T-{i:04}")
+    from_jira.sync(jira, progress=False)
+    assert imported(con) == expected(jira)
+
+
+def test_sync_of_a_late_update(con):
+    # Stamped by a cluster node whose clock is behind the others
+    jira = FakeJira(95)
+    from_jira.sync(jira, full=True, progress=False)
+    jira.time -= timedelta(minutes=2)
+    jira.update("T-0003")
+    from_jira.sync(jira, progress=False)
+    assert imported(con) == expected(jira)
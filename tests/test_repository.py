@@ -0,0 +1,44 @@
+import threading
+import repository
+
+
+def search_while(con, other_searches):
+    # Runs other_searches in another thread while the search of session "a" is
+    # reading its tasks, and returns the results of that search
+    with con:
+        con.executemany(
+            """INSERT INTO tasks (title, due_date, sp, description, sprint, status)
+            VALUES (?, NULL, 1, '', FALSE, 'To Do')""",
+            [(f"Report {i}",) for i in range(50)],
+        )
+
+    def get_tasks(ids):
+        thread = threading.Thread(target=other_searches)
+        thread.start()
+        thread.join()
+        # Long enough for the progress handler to notice
+        con.execute("""WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c
+            WHERE x < 100000) SELECT count(*) FROM c""").fetchone()
+        return repository.get_tasks_by_id(ids)
+
+    try:
+        res, _ = repository.search_tasks("report", session="a", get_tasks=get_tasks)
+    finally:
+        repository.close_all()
+    return res
+
+
+def test_new_search_cancels_the_previous_one(con):
+    def search():
+        repository.search_tasks("report", session="a")
+
+    assert search_while(con, search) is None
+
+
+def test_other_sessions_do_not_cancel_a_search(con):
+    def search():
+        for i in range(repository.SEARCH_CACHE_SIZE + 10):
+            repository.search_tasks("report", session=f"b{i}")
+
+    res = search_while(con, search)
+    assert len(res) == 20
@@ -0,0 +1,65 @@
+import random
+import repository
+import task_cache
+
+
+def test_cache_matches_repository(con):
+    rng = random.Random(0)
+    statuses = ["To Do", "In Progress", "Done"]
+    with con:
+        con.executemany(
+            """INSERT INTO tasks (title, due_date, sp, description, sprint, status)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            [
+                (
+                    f"Task {i}",
+                    None if i % 4 == 0 else f"2024-{i % 12 + 1:02}-{i % 28 + 1:02}",
+                    i % 5,
+                    f"Description {i}",
+                    i % 6 == 0,
+                    rng.choice(statuses),
+                )
+                for i in range(3000)
+            ],
+        )
+    cache = task_cache.TaskCache(repository.db_path())
+
+    def check():
+        assert cache.get_sprint_tasks() == repository.get_sprint_tasks()
+        after = None
+        while True:
+            page = cache.get_backlog_page(after, 100)
+            assert page == repository.get_backlog_page(after, 100)
+            if not page:
+                break
+            after = (page[-1][2] is None, page[-1][2], page[-1][0])
+        for id in rng.sample(range(1, 3100), 100):
+            assert cache.get_task(id) == repository.get_task(id)
+        ids = rng.sample(range(1, 3100), 20)
+        assert cache.get_tasks_by_id(ids) == repository.get_tasks_by_id(ids)
+
+    check()
+    for _ in range(200):
+        id = rng.randint(1, 3000)
+        rng.choice(
+            [
+                lambda: cache.set_task_status(id, rng.choice(statuses)),
+                lambda: cache.toggle_task_sprint(id),
+                lambda: cache.delete_task(id),
+                lambda: cache.insert_task("New", None, 1, "New task", 0, "To Do"),
+            ]
+        )()
+    check()
+    # Another connection
+    repository.write("UPDATE tasks SET status = 'Done' WHERE id < 500")
+    check()
+
+
+def test_start_sprint_twice(con):
+    task_cache.start_sprint("2024-01-01", "2024-01-14")
+    other = task_cache.TaskCache(repository.db_path())
+    other.start_sprint("2024-01-02", "2024-01-15")
+    task_cache.start_sprint("2024-01-03", "2024-01-16")
+    sprints = con.execute("SELECT id, start_date, end_date FROM sprints").fetchall()
+    assert sprints == [(1, "2024-01-03", "2024-01-16")]
+    assert repository.get_current_sprint() == sprints[0]